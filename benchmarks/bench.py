@@ -0,0 +1,158 @@
+"""
+time cython_string_2_stub per construct and overall on generated sources
+results are saved as json baselines, comparing against a baseline fails when the slowdown
+or memory growth exceeds the thresholds
+
+    python benchmarks/bench.py --save benchmarks/baseline.json
+    python benchmarks/bench.py --compare benchmarks/baseline.json
+    python benchmarks/bench.py --engine cython
+
+see engines.py for a side by side comparison of the two engines
+"""
+
+from pathlib import Path
+from typing import Dict, List
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import pyparsing
+
+sys.path.insert(0, str(Path(__file__).parent))
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import cythonpeg  # noqa: E402
+from generate import CONSTRUCTS, generate, generate_all  # noqa: E402
+
+
+def measure(source: str, repeat: int = 3, skip_bodies: bool = False) -> Dict[str, float]:
+    """best of repeat wall time, and peak traced memory of a separate run"""
+
+    lines = source.count("\n") + 1
+
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _, unparsed = cythonpeg.cython_string_2_stub(source, skip_bodies)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    # tracing slows parsing, memory is measured on its own run
+    tracemalloc.start()
+    try:
+        cythonpeg.cython_string_2_stub(source, skip_bodies)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "lines": lines,
+        "seconds": seconds,
+        "lines_per_second": lines / seconds,
+        "peak_memory": peak,
+        "unparsed": len(unparsed),
+    }
+
+
+def run(scale: float = 1.0, repeat: int = 3, skip_bodies: bool = False, constructs: List[str] = None) -> Dict:
+    results = {}
+    for construct in constructs or list(CONSTRUCTS):
+        results[construct] = measure(generate(construct, scale), repeat, skip_bodies)
+        print_result(construct, results[construct])
+
+    if not constructs:
+        results["overall"] = measure(generate_all(scale), repeat, skip_bodies)
+        print_result("overall", results["overall"])
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "pyparsing": pyparsing.__version__,
+            "cythonpeg": cythonpeg.__version__,
+            "scale": scale,
+            "skip_bodies": skip_bodies,
+            "engine": cythonpeg.default_config().engine,
+        },
+        "results": results,
+    }
+
+
+def print_result(name: str, result: Dict[str, float]):
+    print(
+        f"{name:<16} {result['lines']:>7} lines {result['seconds']:>8.3f}s "
+        f"{result['lines_per_second']:>9.0f} lines/s {result['peak_memory'] / 2**20:>8.1f} MB peak"
+    )
+
+
+def compare(current: Dict, baseline: Dict, max_slowdown: float, max_memory_growth: float) -> List[str]:
+    """regressions of current against baseline, thresholds are fractions (0.25 is 25% worse)"""
+
+    if current["meta"]["scale"] != baseline["meta"]["scale"]:
+        return [f"scale {current['meta']['scale']} does not match baseline scale {baseline['meta']['scale']}"]
+    if current["meta"]["engine"] != baseline["meta"].get("engine", "pyparsing"):
+        return [f"engine {current['meta']['engine']} does not match the baseline engine"]
+
+    regressions = []
+    for name, base in baseline["results"].items():
+        result = current["results"].get(name)
+        if result is None:
+            continue
+
+        slowdown = base["lines_per_second"] / result["lines_per_second"] - 1
+        if slowdown > max_slowdown:
+            regressions.append(
+                f"{name}: {result['lines_per_second']:.0f} lines/s, "
+                f"{100 * slowdown:.0f}% slower than baseline {base['lines_per_second']:.0f} lines/s"
+            )
+
+        growth = result["peak_memory"] / base["peak_memory"] - 1 if base["peak_memory"] else 0.0
+        if growth > max_memory_growth:
+            regressions.append(
+                f"{name}: {result['peak_memory'] / 2**20:.1f} MB peak, "
+                f"{100 * growth:.0f}% more than baseline {base['peak_memory'] / 2**20:.1f} MB"
+            )
+
+        if result["unparsed"] > base["unparsed"]:
+            regressions.append(f"{name}: {result['unparsed']} unparsed characters, baseline {base['unparsed']}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cythonpeg parser benchmarks")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier of the generated construct counts")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark, the best is kept")
+    parser.add_argument("--skip-bodies", action="store_true")
+    parser.add_argument("--engine", choices=cythonpeg.ENGINES, default="pyparsing", help="parser building the IR")
+    parser.add_argument("--construct", action="append", choices=list(CONSTRUCTS), help="only these constructs")
+    parser.add_argument("--save", type=Path, help="write the results as a json baseline")
+    parser.add_argument("--compare", type=Path, help="json baseline to compare against")
+    parser.add_argument("--max-slowdown", type=float, default=0.25, help="allowed slowdown fraction (default 0.25)")
+    parser.add_argument(
+        "--max-memory-growth", type=float, default=0.25, help="allowed peak memory growth fraction (default 0.25)"
+    )
+    args = parser.parse_args()
+
+    cythonpeg.set_engine(args.engine)
+    current = run(args.scale, args.repeat, args.skip_bodies, args.construct)
+
+    if args.save is not None:
+        with open(args.save, "w") as file:
+            json.dump(current, file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+
+        regressions = compare(current, baseline, args.max_slowdown, args.max_memory_growth)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
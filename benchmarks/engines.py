@@ -0,0 +1,83 @@
+"""
+compare the pyparsing and cython engines on the tests/cython corpus and the generated sources
+prints the best of repeat time of each engine and whether stubs and unparsed text match,
+exits with 1 when any output differs
+
+    python benchmarks/engines.py
+    python benchmarks/engines.py --scale 4 --repeat 5
+"""
+
+from pathlib import Path
+from typing import Dict, Tuple
+import argparse
+import difflib
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).parent))
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import cythonpeg  # noqa: E402
+from generate import CONSTRUCTS, generate  # noqa: E402
+
+CORPUS = Path(__file__).parent.parent / "tests" / "cython"
+
+
+def best_of(source: str, engine: str, repeat: int) -> Tuple[float, Tuple[str, str]]:
+    config = cythonpeg.StubConfig(engine=engine)
+
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = cythonpeg.cython_string_2_stub(source, config=config)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    return seconds, output
+
+
+def sources(scale: float) -> Dict[str, str]:
+    named = {path.name: path.read_text() for path in sorted(CORPUS.glob("*.pyx"))}
+    named.update((construct, generate(construct, scale)) for construct in CONSTRUCTS)
+    return named
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pyparsing and cython engine comparison")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier of the generated construct counts")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per engine, the best is kept")
+    args = parser.parse_args()
+
+    # imports and grammar construction are not part of the comparison
+    for engine in cythonpeg.ENGINES:
+        cythonpeg.cython_string_2_stub("def f():\n    pass\n", config=cythonpeg.StubConfig(engine=engine))
+
+    differences = 0
+    totals = dict.fromkeys(cythonpeg.ENGINES, 0.0)
+    for name, source in sources(args.scale).items():
+        results = {engine: best_of(source, engine, args.repeat) for engine in cythonpeg.ENGINES}
+        for engine, (seconds, _) in results.items():
+            totals[engine] += seconds
+
+        (pyparsing_seconds, expected), (cython_seconds, output) = results["pyparsing"], results["cython"]
+        status = "same" if output == expected else "DIFFERENT"
+        differences += output != expected
+        print(
+            f"{name:<20} {1000 * pyparsing_seconds:>9.1f} ms {1000 * cython_seconds:>9.1f} ms "
+            f"{pyparsing_seconds / cython_seconds:>7.1f}x  {status}"
+        )
+
+        if output[0] != expected[0]:
+            diff = difflib.unified_diff(expected[0].splitlines(True), output[0].splitlines(True), "pyparsing", "cython")
+            sys.stdout.writelines(diff)
+
+    print(
+        f"{'total':<20} {1000 * totals['pyparsing']:>9.1f} ms {1000 * totals['cython']:>9.1f} ms "
+        f"{totals['pyparsing'] / totals['cython']:>7.1f}x  {differences} different"
+    )
+
+    if differences:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
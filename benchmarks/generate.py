@@ -0,0 +1,161 @@
+"""synthetic cython sources for benchmarking, every construct generator returns fully parseable code"""
+
+import argparse
+import random
+from typing import Callable, Dict, List
+
+C_TYPES = ["int", "double", "float", "long", "bint", "size_t", "float64", "Py_ssize_t"]
+MEMORY_VIEWS = ["float[:]", "double[:, :]", "int[::1]", "float[:, :, :]"]
+
+
+def _type(rng: random.Random) -> str:
+    return rng.choice(C_TYPES + MEMORY_VIEWS) if rng.random() < 0.3 else rng.choice(C_TYPES)
+
+
+def _arguments(rng: random.Random, count: int) -> str:
+    arguments = []
+    for i in range(count):
+        # trailing arguments have defaults
+        if i >= count // 2:
+            arguments.append(f"{rng.choice(C_TYPES)} a{i}={rng.randint(0, 9)}")
+        else:
+            arguments.append(f"{_type(rng)} a{i}")
+    return ", ".join(arguments)
+
+
+def _body(rng: random.Random, lines: int, indent: str) -> List[str]:
+    """statement soup, loops and branches nest up to three levels"""
+
+    body = []
+    depth = 0
+    for i in range(lines):
+        prefix = indent + "    " * depth
+        choice = rng.random()
+        if choice < 0.15 and depth < 3:
+            body.append(f"{prefix}for i{depth} in range({rng.randint(1, 100)}):")
+            depth += 1
+            body.append(f"{indent}{'    ' * depth}x{i} = i{depth - 1} * {rng.randint(1, 9)}")
+        elif choice < 0.25 and depth < 3:
+            body.append(f"{prefix}if x > {rng.randint(0, 9)}:")
+            depth += 1
+            body.append(f"{indent}{'    ' * depth}x = x - 1")
+        elif choice < 0.35 and depth > 0:
+            depth -= 1
+            body.append(f"{indent}{'    ' * depth}y{i} = [x, {i}, (x + {i}) // 2]")
+        else:
+            body.append(f"{prefix}x = x + {i}")
+    body.append(f"{indent}return x")
+    return body
+
+
+def cdef_classes(rng: random.Random, count: int) -> str:
+    lines = []
+    for c in range(count):
+        lines.append(f"cdef class Class{c}(object):")
+        lines.append(f'    """class {c} documentation"""')
+        lines.append("")
+        lines.append(f"    def __init__(self, {_arguments(rng, 3)}):")
+        lines.append("        pass")
+        for m in range(rng.randint(2, 6)):
+            lines.append("")
+            lines.append(f"    cpdef {rng.choice(C_TYPES)} method{m}(self, {_arguments(rng, rng.randint(1, 4))}):")
+            lines.append(f'        """method {m}"""')
+            lines.extend(_body(rng, rng.randint(1, 5), "        "))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def long_arguments(rng: random.Random, count: int) -> str:
+    lines = []
+    for f in range(count):
+        keyword = rng.choice(["def", "cdef", "cpdef"])
+        return_type = "" if keyword == "def" else f"{rng.choice(C_TYPES)} "
+        lines.append(f"{keyword} {return_type}function{f}({_arguments(rng, rng.randint(10, 40))}):")
+        lines.append("    return 0")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def deep_nesting(rng: random.Random, count: int) -> str:
+    lines = []
+    for n in range(count):
+        # parse time roughly doubles with every level
+        depth = rng.randint(2, 6)
+        for d in range(depth):
+            lines.append(f"{'    ' * d}class Nested{n}_{d}:")
+            lines.append(f'{"    " * (d + 1)}"""depth {d}"""')
+        indent = "    " * depth
+        lines.append(f"{indent}def method(self, {_arguments(rng, 2)}):")
+        lines.append(f"{indent}    def inner(x):")
+        lines.append(f"{indent}        def innermost(y):")
+        lines.append(f"{indent}            return y")
+        lines.append(f"{indent}        return innermost(x)")
+        lines.append(f"{indent}    return inner(a0)")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def extern_blocks(rng: random.Random, count: int) -> str:
+    lines = []
+    for e in range(count):
+        lines.append(f'cdef extern from "library{e}.h":')
+        for f in range(rng.randint(20, 60)):
+            types = ", ".join(rng.choice(C_TYPES) for _ in range(rng.randint(1, 5)))
+            lines.append(f"    {rng.choice(C_TYPES)} extern{e}_{f}({types})")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def function_bodies(rng: random.Random, count: int) -> str:
+    lines = []
+    for f in range(count):
+        lines.append(f"cpdef double body{f}(double x):")
+        lines.append(f'    """function {f} with a large body"""')
+        lines.extend(_body(rng, rng.randint(200, 600), "    "))
+        lines.append("")
+    return "\n".join(lines)
+
+
+CONSTRUCTS: Dict[str, Callable[[random.Random, int], str]] = {
+    "cdef_classes": cdef_classes,
+    "long_arguments": long_arguments,
+    "deep_nesting": deep_nesting,
+    "extern_blocks": extern_blocks,
+    "function_bodies": function_bodies,
+}
+
+# construct counts at scale 1.0
+DEFAULT_COUNTS = {
+    "cdef_classes": 20,
+    "long_arguments": 30,
+    "deep_nesting": 20,
+    "extern_blocks": 10,
+    "function_bodies": 4,
+}
+
+
+def generate(construct: str, scale: float = 1.0, seed: int = 0) -> str:
+    rng = random.Random(f"{construct}{seed}")
+    return CONSTRUCTS[construct](rng, max(1, int(DEFAULT_COUNTS[construct] * scale))) + "\n"
+
+
+def generate_all(scale: float = 1.0, seed: int = 0) -> str:
+    """every construct in one source"""
+    return "\n".join(generate(construct, scale, seed) for construct in CONSTRUCTS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="write a synthetic cython source")
+    parser.add_argument("output", help="output .pyx path")
+    parser.add_argument("--construct", choices=list(CONSTRUCTS), default=None, help="single construct (default all)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier of the construct counts")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.construct is None:
+        source = generate_all(args.scale, args.seed)
+    else:
+        source = generate(args.construct, args.scale, args.seed)
+
+    with open(args.output, "w") as file:
+        file.write(source)
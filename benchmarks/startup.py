@@ -0,0 +1,115 @@
+"""
+startup cost of fresh interpreters: bare interpreter, package import, a no-op cli run and the
+latency of the first parse (import + grammar construction + parse)
+
+    python benchmarks/startup.py --save startup.json
+    python benchmarks/startup.py --compare startup.json
+"""
+
+from pathlib import Path
+from typing import Dict, List
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+SRC = str(Path(__file__).parent.parent / "src")
+
+FIRST_PARSE = """
+import time
+start = time.perf_counter()
+import cythonpeg
+cythonpeg.cython_string_2_stub("cdef class A:\\n    cdef int method(self, int a):\\n        return a\\n")
+print(time.perf_counter() - start)
+"""
+
+SNIPPETS = {
+    "interpreter": "pass",
+    "import": "import cythonpeg",
+    "set_type_converter": "from cythonpeg import set_type_converter_partial",
+    "cli_noop": (
+        "import sys; sys.argv = ['cythonpeg', '__no_such_file__.pyx', '--no-cache']\n"
+        "from cythonpeg.entrypoints import entrypoint; entrypoint()"
+    ),
+}
+
+
+def _environment() -> Dict[str, str]:
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [SRC, environment.get("PYTHONPATH")]))
+    return environment
+
+
+def measure(snippet: str, repeat: int) -> float:
+    """best of repeat wall time of a fresh interpreter running snippet"""
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", snippet], env=_environment(), check=True, capture_output=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_first_parse(repeat: int) -> float:
+    """best of repeat time from import to the first stub, measured inside the interpreter"""
+
+    best = float("inf")
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", FIRST_PARSE], env=_environment(), check=True, capture_output=True, text=True
+        )
+        best = min(best, float(output.stdout))
+    return best
+
+
+def run(repeat: int = 10) -> Dict[str, float]:
+    results = {name: measure(snippet, repeat) for name, snippet in SNIPPETS.items()}
+    results["first_parse"] = measure_first_parse(repeat)
+
+    for name, seconds in results.items():
+        overhead = ""
+        if name in SNIPPETS and name != "interpreter":
+            overhead = f" (+{1000 * (seconds - results['interpreter']):.1f} ms over interpreter)"
+        print(f"{name:<20} {1000 * seconds:>8.1f} ms{overhead}")
+
+    return results
+
+
+def compare(current: Dict[str, float], baseline: Dict[str, float], max_slowdown: float) -> List[str]:
+    regressions = []
+    for name, base in baseline.items():
+        if name in current and current[name] / base - 1 > max_slowdown:
+            regressions.append(f"{name}: {1000 * current[name]:.1f} ms, baseline {1000 * base:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cythonpeg startup benchmarks")
+    parser.add_argument("--repeat", type=int, default=10, help="runs per measurement, the best is kept")
+    parser.add_argument("--save", type=Path, help="write the results as a json baseline")
+    parser.add_argument("--compare", type=Path, help="json baseline to compare against")
+    parser.add_argument("--max-slowdown", type=float, default=0.25, help="allowed slowdown fraction (default 0.25)")
+    args = parser.parse_args()
+
+    current = run(args.repeat)
+
+    if args.save is not None:
+        with open(args.save, "w") as file:
+            json.dump(current, file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as file:
+            regressions = compare(current, json.load(file), args.max_slowdown)
+
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,50 @@ __version__ = "0.1.0"
 from cythonpeg.tree2string import (
     set_indent,
     cython_string_2_stub,
+    cython_file_2_stub,
+    cython_string_2_report,
+    cython_string_2_module,
+    module2str,
+    iter_stub_fragments,
+    write_stub,
+    StubConfig,
+    default_config,
+    StubFragment,
+    StubReport,
+    UnparsedSpan,
     set_type_converter_partial,
     set_type_converter_complete,
+    set_symbol_index,
+    set_engine,
+    ENGINES,
+    set_error_recovery,
+    set_raw_defaults,
+    set_extern_declarations,
+    Diagnostic,
 )
-import logging
+from cythonpeg.segmenter import segment_blocks, cython_string_2_report_blocks, IncrementalStub
+from cythonpeg.typemap import TypeMap, standard_type_map
+from cythonpeg.batch import cython_sources_2_stubs, BatchResult
 
-logging.basicConfig(level=logging.INFO)
+# names that import pyparsing, resolved on first access
+_lazy_attributes = {
+    "enable_memoization": "cythonpeg.utilities",
+    "disable_memoization": "cythonpeg.utilities",
+    "memoization_stats": "cythonpeg.utilities",
+    "reset_memoization_stats": "cythonpeg.utilities",
+    "GrammarProfiler": "cythonpeg.profiling",
+    "SymbolIndex": "cythonpeg.symbols",
+    "build_symbol_index": "cythonpeg.symbols",
+    "AsyncStubGenerator": "cythonpeg.aio",
+    "cython_string_2_stub_async": "cythonpeg.aio",
+    "cython_file_2_stub_async": "cythonpeg.aio",
+    "stub_from_path_async": "cythonpeg.aio",
+}
+
+
+def __getattr__(name: str):
+    if name in _lazy_attributes:
+        import importlib
+
+        return getattr(importlib.import_module(_lazy_attributes[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,228 @@
+from __future__ import annotations
+from concurrent.futures import CancelledError, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Tuple, Union
+import asyncio
+import threading
+from cythonpeg.cache import StubCache
+from cythonpeg.entrypoints import log_diagnostics, path_config, write_if_changed
+from cythonpeg.segmenter import block_fragments, block_report, segment_blocks
+from cythonpeg.tree2string import (
+    StubConfig,
+    StubReport,
+    cython_string_2_report,
+    cython_string_2_stub,
+    default_config,
+    prepare_source,
+)
+
+
+def _read(path: Union[Path, str]) -> str:
+    with open(path, "r") as file:
+        return file.read()
+
+
+async def _in_thread(function: Callable, *args):
+    """blocking file and cache i/o runs in the default executor of the loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+def _cancellable_report(
+    input_code: str, skip_bodies: bool, config: Union[StubConfig, None], cancelled: threading.Event
+) -> StubReport:
+    """cython_string_2_report_blocks in this thread, stops at the next top level block once cancelled is set"""
+
+    config = config or default_config()
+    prepared_code = prepare_source(input_code, config)
+    blocks = [(start, prepared_code[start:end]) for start, end in segment_blocks(prepared_code)]
+
+    def results():
+        for block in blocks:
+            if cancelled.is_set():
+                raise CancelledError()
+            yield block_fragments(block, skip_bodies, config)
+
+    return block_report(prepared_code, blocks, results())
+
+
+async def cython_string_2_stub_async(
+    input_code: str,
+    skip_bodies: bool = False,
+    config: Union[StubConfig, None] = None,
+    executor: Union[Executor, None] = None,
+) -> Tuple[str, str]:
+    """cython_string_2_stub parsed in executor (default executor of the loop)"""
+    # resolved here, workers started by spawn do not share the set_* globals (the config has to be picklable)
+    config = config or default_config()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, cython_string_2_stub, input_code, skip_bodies, config)
+
+
+async def cython_file_2_stub_async(
+    path: Union[Path, str],
+    skip_bodies: bool = False,
+    config: Union[StubConfig, None] = None,
+    executor: Union[Executor, None] = None,
+) -> Tuple[str, str]:
+    """cython_file_2_stub with the file read in a thread and parsed in executor"""
+    input_code = await _in_thread(_read, path)
+    return await cython_string_2_stub_async(input_code, skip_bodies, config, executor)
+
+
+async def _stub_path(
+    path: Path,
+    cache: Union[StubCache, None],
+    skip_bodies: bool,
+    config: StubConfig,
+    report: Callable[[str, StubConfig], Awaitable[StubReport]],
+) -> Tuple[int, bool, bool]:
+    # stub_from_path with the file and cache i/o in threads and the parse awaited from report
+    input_string = await _in_thread(_read, path)
+    key = cache.key(input_string, config, skip_bodies=skip_bodies) if cache is not None else ""
+    entry = await _in_thread(cache.get, key) if cache is not None else None
+
+    if entry is not None:
+        stub_file, unparsed_characters = entry
+    else:
+        parsed = await report(input_string, config)
+        stub_file, unparsed_characters = parsed.stub, parsed.unparsed_text
+        log_diagnostics(path, parsed.diagnostics)
+        if cache is not None:
+            await _in_thread(cache.set, key, stub_file, unparsed_characters)
+
+    written = await _in_thread(write_if_changed, path.with_suffix(".pyi"), stub_file)
+    return len(unparsed_characters), entry is not None, written
+
+
+async def stub_from_path_async(
+    path: Union[Path, str],
+    cache: Union[StubCache, None] = None,
+    skip_bodies: bool = False,
+    executor: Union[Executor, None] = None,
+    config: Union[StubConfig, None] = None,
+) -> Tuple[int, bool, bool]:
+    """stub_from_path with the file and cache i/o in threads and the parse in executor (default executor of the loop)"""
+
+    async def report(input_string: str, config: StubConfig) -> StubReport:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, cython_string_2_report, input_string, skip_bodies, config)
+
+    path = Path(path)
+    return await _stub_path(path, cache, skip_bodies, path_config(path, config), report)
+
+
+class AsyncStubGenerator:
+    """
+    stub generation for async servers, parses run in executor (a thread or process pool, default an owned thread pool)
+    limit: at most limit parses run at once, the others wait for a slot
+    requests with a name (stub_file and stub_path use the path) cancel the pending request of that name,
+    an edit burst parses the latest version instead of queueing every version behind each other
+    cancelled parses that did not start are dropped, in a thread pool a running parse stops at its next top level block
+    and in a process pool it runs to the end (holding its slot)
+    """
+
+    def __init__(
+        self,
+        executor: Union[Executor, None] = None,
+        limit: Union[int, None] = None,
+        skip_bodies: bool = False,
+        config: Union[StubConfig, None] = None,
+    ):
+        self.limit = limit
+        self.skip_bodies = skip_bodies
+        # None is resolved when a parse is submitted, the config has to be picklable for a process pool
+        self.config = config
+        self._executor = executor
+        self._owned = executor is None
+        self._slots: Union[asyncio.Semaphore, None] = None
+        self._latest: Dict[str, asyncio.Future] = {}
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.limit)
+        return self._executor
+
+    def close(self):
+        """cancel pending requests and shut down the owned thread pool"""
+        for future in list(self._latest.values()):
+            future.cancel()
+        if self._owned and self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def __aenter__(self) -> AsyncStubGenerator:
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def _parse(self, input_code: str, config: Union[StubConfig, None]) -> StubReport:
+        # resolved here, workers started by spawn do not share the set_* globals
+        config = config or default_config()
+        loop = asyncio.get_running_loop()
+        # created in the running loop, python 3.8 binds a semaphore to the loop it is created in
+        if self.limit and self._slots is None:
+            self._slots = asyncio.Semaphore(self.limit)
+        if self._slots is not None:
+            await self._slots.acquire()
+
+        executor = self._get_executor()
+        cancelled = threading.Event()
+        try:
+            if isinstance(executor, ProcessPoolExecutor):
+                future: Future = executor.submit(cython_string_2_report, input_code, self.skip_bodies, config)
+            else:
+                future = executor.submit(_cancellable_report, input_code, self.skip_bodies, config, cancelled)
+        except BaseException:
+            if self._slots is not None:
+                self._slots.release()
+            raise
+
+        # the slot is held until the parse stops, not until the request is cancelled
+        if self._slots is not None:
+            future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._slots.release))
+
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def report(self, input_code: str, name: Union[str, None] = None) -> StubReport:
+        """cython_string_2_report, a request with a name cancels the pending request of that name"""
+        return await self._latest_report(input_code, self.config, name)
+
+    async def _latest_report(self, input_code: str, config: Union[StubConfig, None], name: Union[str, None]):
+        if name is None:
+            return await self._parse(input_code, config)
+
+        previous = self._latest.get(name)
+        if previous is not None:
+            previous.cancel()
+
+        request = asyncio.ensure_future(self._parse(input_code, config))
+        self._latest[name] = request
+        try:
+            return await request
+        finally:
+            if self._latest.get(name) is request:
+                del self._latest[name]
+
+    async def stub(self, input_code: str, name: Union[str, None] = None) -> Tuple[str, str]:
+        """cython_string_2_stub, a request with a name cancels the pending request of that name"""
+        report = await self.report(input_code, name)
+        return report.stub, report.unparsed_text
+
+    async def stub_file(self, path: Union[Path, str]) -> Tuple[str, str]:
+        """cython_file_2_stub with the file read in a thread"""
+        input_code = await _in_thread(_read, path)
+        return await self.stub(input_code, str(path))
+
+    async def stub_path(self, path: Union[Path, str], cache: Union[StubCache, None] = None) -> Tuple[int, bool, bool]:
+        """stub_from_path, returns the unparsed character count, if the cache was hit and if the stub was written"""
+
+        async def report(input_string: str, config: StubConfig) -> StubReport:
+            return await self._latest_report(input_string, config, str(path))
+
+        path = Path(path)
+        return await _stub_path(path, cache, self.skip_bodies, path_config(path, self.config), report)
@@ -0,0 +1,142 @@
+from __future__ import annotations
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Tuple, Union, TYPE_CHECKING
+import os
+import time
+from cythonpeg.tree2string import Diagnostic, StubConfig, UnparsedSpan, cython_string_2_report, default_config
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+# a path or a (name, source) pair
+BatchItem = Union[str, os.PathLike, Tuple[str, str]]
+
+
+class BatchResult(NamedTuple):
+    """stub of one batch item, error is set (and the report fields empty) when the item could not be read or parsed"""
+
+    name: str
+    stub: str
+    unparsed: List[UnparsedSpan]
+    unparsed_text: str
+    coverage: float
+    diagnostics: List[Diagnostic]
+    seconds: float
+    error: str = ""
+
+
+def _item_name(item: BatchItem) -> str:
+    return item[0] if isinstance(item, tuple) else str(item)
+
+
+def _error_result(item: BatchItem, error: Exception, seconds: float = 0.0) -> BatchResult:
+    return BatchResult(_item_name(item), "", [], "", 0.0, [], seconds, f"{type(error).__name__}: {error}")
+
+
+def _batch_job(item: BatchItem, skip_bodies: bool = False, config: Union[StubConfig, None] = None) -> BatchResult:
+    start = time.perf_counter()
+    path = None if isinstance(item, tuple) else Path(item)
+    name = _item_name(item)
+
+    try:
+        if path is None:
+            input_code = item[1]
+        else:
+            with open(path, "r") as file:
+                input_code = file.read()
+
+        config = config or default_config()
+        if path is not None and config.symbols is not None:
+            # names defined in this file are left to its own stub
+            config = config._replace(symbols=config.symbols.for_file(path))
+
+        report = cython_string_2_report(input_code, skip_bodies, config)
+    except Exception as e:
+        return _error_result(item, e, time.perf_counter() - start)
+
+    return BatchResult(
+        name,
+        report.stub,
+        report.unparsed,
+        report.unparsed_text,
+        report.coverage,
+        report.diagnostics,
+        time.perf_counter() - start,
+    )
+
+
+def _submit(executor: Executor, job: Callable, item: BatchItem) -> Future:
+    try:
+        return executor.submit(job, item)
+    except Exception as e:
+        # e.g. a broken pool, reported in the result of the item
+        future = Future()
+        future.set_exception(e)
+        return future
+
+
+def _result(item: BatchItem, future: Future) -> BatchResult:
+    try:
+        return future.result()
+    except Exception as e:
+        # the item or config did not pickle or the worker died
+        return _error_result(item, e)
+
+
+def _ordered_results(
+    executor: Executor, job: Callable, items: Iterable[BatchItem], window: int
+) -> Iterator[BatchResult]:
+    """executor.map that reads items at most window ahead of the results consumed, failures become results"""
+
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, _submit(executor, job, item)))
+            if len(pending) >= window:
+                yield _result(*pending.popleft())
+        while pending:
+            yield _result(*pending.popleft())
+    finally:
+        # the consumer stopped early
+        for _, future in pending:
+            future.cancel()
+
+
+def cython_sources_2_stubs(
+    items: Iterable[BatchItem],
+    skip_bodies: bool = False,
+    config: Union[StubConfig, None] = None,
+    jobs: Union[int, None] = 1,
+    executor: Union[Executor, None] = None,
+) -> Iterator[BatchResult]:
+    """
+    stubs of many sources, yielded lazily in item order
+    items: paths or (name, source) pairs, read as they are consumed
+    the config (type converters and their memo, symbol index) is resolved once and the grammar is built once
+    for all items, a failing item is reported in its result instead of stopping the batch
+    jobs: parse in a process pool of jobs workers (None for one per cpu) or in executor,
+    the config is resolved here and sent to the workers, it has to be picklable
+    """
+
+    # workers started by spawn do not share the set_* globals
+    config = config or default_config()
+
+    if executor is None and jobs == 1:
+        for item in items:
+            yield _batch_job(item, skip_bodies, config)
+        return
+
+    job = partial(_batch_job, skip_bodies=skip_bodies, config=config)
+    window = 4 * (jobs or os.cpu_count() or 1)
+
+    if executor is not None:
+        yield from _ordered_results(executor, job, items, window)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from _ordered_results(pool, job, items, window)
@@ -0,0 +1,143 @@
+from pathlib import Path
+from typing import Callable, Tuple, Union
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+from cythonpeg import __version__
+from cythonpeg import tree2string
+
+
+def default_cache_dir() -> Path:
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "cythonpeg"
+
+
+def _callable_fingerprint(func: Callable) -> str:
+    """identify a type converter by name and implementation, methods also by their object repr"""
+
+    func = inspect.unwrap(func)
+    code = getattr(func, "__code__", None)
+    name = f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+
+    owner = getattr(func, "__self__", None)
+    if owner is not None:
+        name += repr(owner)
+
+    if code is None:
+        return name
+
+    return name + hashlib.sha256(code.co_code + repr(code.co_consts).encode()).hexdigest()
+
+
+def config_fingerprint(config: Union[tree2string.StubConfig, None] = None) -> str:
+    """fingerprint of a stub configuration (all StubConfig fields), defaults to the set_* values"""
+
+    config = config or tree2string.default_config()
+    return "\0".join(
+        [
+            __version__,
+            config.indent,
+            _callable_fingerprint(config.type_converter_partial),
+            _callable_fingerprint(config.type_converter_complete),
+            config.symbols.fingerprint() if config.symbols is not None else "",
+            config.engine,
+            str(config.recover),
+            str(config.raw_defaults),
+            str(config.extern_declarations),
+        ]
+    )
+
+
+class StubCache:
+    """persistent stub cache keyed on source hash, package version and stub configuration"""
+
+    def __init__(self, directory: Union[Path, str, None] = None, max_size: int = 64 * 2**20):
+        self.directory = Path(directory) if directory is not None else default_cache_dir()
+        self.max_size = max_size
+
+    def key(self, source: str, config: Union[tree2string.StubConfig, None] = None, **options) -> str:
+        """options are the parsing options that can change the stub"""
+        digest = hashlib.sha256(config_fingerprint(config).encode())
+        digest.update(repr(sorted(options.items())).encode())
+        digest.update(source.encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get_entry(self, key: str) -> Union[dict, None]:
+        """cached json entry for key or None"""
+
+        path = self._path(key)
+        try:
+            with open(path, "r") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        # access time for least recently used eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return entry
+
+    def set_entry(self, key: str, entry: dict):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write then rename, concurrent workers never observe partial entries
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(entry, file)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def get(self, key: str) -> Union[Tuple[str, str], None]:
+        """cached (stub, unparsed) for key or None"""
+
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+
+        return entry["stub"], entry["unparsed"]
+
+    def set(self, key: str, stub: str, unparsed: str):
+        self.set_entry(key, {"stub": stub, "unparsed": unparsed})
+
+    def evict(self) -> int:
+        """remove least recently used entries until the cache fits max_size, returns removed count"""
+
+        entries = []
+        for path in self.directory.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+
+        return removed
+
+    def clear(self):
+        for path in self.directory.glob("*/*.json"):
+            try:
+                path.unlink()
+            except OSError:
+                pass
@@ -0,0 +1,487 @@
+from functools import partial
+from typing import Iterator, List, Tuple, Union
+import re
+import threading
+from Cython.Compiler import Errors, ExprNodes, Nodes
+from Cython.Compiler.TreeFragment import parse_from_strings
+from cythonpeg import ir
+
+# Cython keeps its error state in module globals
+_lock = threading.Lock()
+
+docstring_start = re.compile(r"[rRuU]?(\"\"\"|''')")
+# string literal with its prefix, adjacent literals are concatenated
+string_literal = re.compile(
+    r"[rRbBuU]{0,2}(?:'''(?:\\.|[^\\])*?'''|\"\"\"(?:\\.|[^\\])*?\"\"\"|'(?:\\.|[^\\'\n])*'|\"(?:\\.|[^\\\"\n])*\")"
+    r"(?:[ \t]*[rRbBuU]{0,2}(?:'(?:\\.|[^\\'\n])*'|\"(?:\\.|[^\\\"\n])*\"))*",
+    re.S,
+)
+
+
+class CythonSyntaxError(Exception):
+    pass
+
+
+def parse_tree(prepared_code: str) -> Nodes.StatListNode:
+    """top level statements of Cython's parse tree, raises CythonSyntaxError on invalid source"""
+
+    with _lock:
+        Errors.init_thread()
+        try:
+            return parse_from_strings("stub", prepared_code).body
+        except Errors.CompileError as e:
+            raise CythonSyntaxError(str(e).strip()) from None
+
+
+def expression_text(node, source: Union["_Source", None] = None) -> str:
+    """
+    ExprNode to source text, written the way the pyparsing engine writes defaults
+    source: string literals are copied from it as written (quotes, prefixes and escapes)
+    """
+
+    text = partial(expression_text, source=source)
+    if node is None:
+        return ""
+    if isinstance(node, (ExprNodes.IntNode, ExprNodes.FloatNode)):
+        return str(node.value)
+    if isinstance(node, (ExprNodes.UnicodeNode, ExprNodes.BytesNode)):
+        literal = source.literal(node) if source is not None else None
+        return literal if literal is not None else repr(node.value)
+    if isinstance(node, ExprNodes.NoneNode):
+        return "None"
+    if isinstance(node, ExprNodes.BoolNode):
+        return str(node.value)
+    if isinstance(node, ExprNodes.NameNode):
+        return node.name
+    if isinstance(node, ExprNodes.AttributeNode):
+        return f"{text(node.obj)}.{node.attribute}"
+    if isinstance(node, ExprNodes.UnaryMinusNode):
+        return f"-{text(node.operand)}"
+    if isinstance(node, ExprNodes.NotNode):
+        return f"not {text(node.operand)}"
+    if isinstance(node, ExprNodes.UnopNode):
+        return f"{node.operator}{text(node.operand)}"
+    if isinstance(node, ExprNodes.BinopNode):
+        return f"{text(node.operand1)}{node.operator}{text(node.operand2)}"
+    if isinstance(node, ExprNodes.ListNode):
+        return "[" + ", ".join(text(arg) for arg in node.args) + "]"
+    if isinstance(node, ExprNodes.TupleNode):
+        # a one element tuple keeps its comma
+        return "(" + ", ".join(text(arg) for arg in node.args) + ("," if len(node.args) == 1 else "") + ")"
+    if isinstance(node, ExprNodes.SetNode):
+        return "{" + ", ".join(text(arg) for arg in node.args) + "}"
+    if isinstance(node, ExprNodes.DictNode):
+        items = (f"{text(item.key)} : {text(item.value)}" for item in node.key_value_pairs)
+        return "{" + ", ".join(items) + "}"
+    if isinstance(node, ExprNodes.SimpleCallNode):
+        return f"{text(node.function)}({', '.join(text(arg) for arg in node.args)})"
+    if isinstance(node, ExprNodes.GeneralCallNode):
+        args = [text(arg) for arg in getattr(node.positional_args, "args", [])]
+        args += [f"{item.key.value}={text(item.value)}" for item in getattr(node.keyword_args, "key_value_pairs", [])]
+        return f"{text(node.function)}({', '.join(args)})"
+    if isinstance(node, ExprNodes.IndexNode):
+        return f"{text(node.base)}[{text(node.index)}]"
+
+    # anything else is valid python the stub cannot spell out
+    return "..."
+
+
+def annotation_type(node) -> ir.Type:
+    """annotation ExprNode to Type, subscripts become type arguments"""
+
+    if isinstance(node, ExprNodes.AnnotationNode):
+        node = node.expr
+    if isinstance(node, ExprNodes.IndexNode):
+        index = node.index.args if isinstance(node.index, ExprNodes.TupleNode) else [node.index]
+        return ir.Type(expression_text(node.base), [annotation_type(arg) for arg in index])
+    return ir.Type(expression_text(node))
+
+
+def _declarator(declarator) -> Tuple[str, int]:
+    """name and pointer depth of a declarator"""
+
+    pointers = 0
+    while not isinstance(declarator, Nodes.CNameDeclaratorNode):
+        if isinstance(declarator, Nodes.CPtrDeclaratorNode):
+            pointers += 1
+        declarator = declarator.base
+    return declarator.name or "", pointers
+
+
+def _function_pointer(declarator) -> bool:
+    while not isinstance(declarator, Nodes.CNameDeclaratorNode):
+        if isinstance(declarator, Nodes.CFuncDeclaratorNode):
+            return True
+        declarator = declarator.base
+    return False
+
+
+def _simple_name(base: Nodes.CSimpleBaseTypeNode) -> str:
+    name = base.name or ""
+    if name == "int" and base.longness:
+        name = "short" if base.longness < 0 else " ".join(["long"] * base.longness)
+    elif base.longness > 0:
+        name = f"long {name}"
+    if base.complex:
+        name = f"{name} complex"
+    if base.name in ("char", "int") and base.signed != 1:
+        # 0 unsigned, 2 explicitly signed
+        name = f"{'unsigned' if base.signed == 0 else 'signed'} {name}"
+    return ".".join(list(base.module_path) + [name])
+
+
+def _axis(axis) -> str:
+    if not isinstance(axis, ExprNodes.SliceNode):
+        return expression_text(axis)
+
+    # omitted bounds are NoneNodes
+    start, stop, step = (
+        "" if isinstance(bound, ExprNodes.NoneNode) else expression_text(bound)
+        for bound in (axis.start, axis.stop, axis.step)
+    )
+    return f"{start}:{stop}" + (f":{step}" if step else "")
+
+
+def base_type(base, pointers: int = 0) -> ir.Type:
+    """CBaseTypeNode (and the pointer depth of its declarator) to Type"""
+
+    if isinstance(base, Nodes.CSimpleBaseTypeNode):
+        return ir.Type(_simple_name(base) + "*" * pointers)
+
+    if isinstance(base, Nodes.MemoryViewSliceTypeNode):
+        return ir.Type(base_type(base.base_type_node).name, [ir.Type(_axis(axis)) for axis in base.axes])
+
+    if isinstance(base, Nodes.TemplatedTypeNode):
+        args = [
+            base_type(arg) if isinstance(arg, Nodes.CBaseTypeNode) else ir.Type(expression_text(arg))
+            for arg in base.positional_args
+        ]
+        keywords = getattr(base.keyword_args, "key_value_pairs", [])
+        args += [ir.Type(item.key.value, default=expression_text(item.value)) for item in keywords]
+        return ir.Type(base_type(base.base_type_node).name + "*" * pointers, args)
+
+    if isinstance(base, Nodes.CComplexBaseTypeNode):
+        _, inner = _declarator(base.declarator)
+        return base_type(base.base_type, pointers + inner)
+
+    if hasattr(base, "base_type"):
+        # const / volatile
+        return base_type(base.base_type, pointers)
+
+    return ir.Type("object")
+
+
+def _untyped(base) -> bool:
+    return isinstance(base, Nodes.CSimpleBaseTypeNode) and not base.module_path and not base.longness
+
+
+def build_arg(arg: Nodes.CArgDeclNode, source: Union["_Source", None] = None) -> ir.Arg:
+    name, pointers = _declarator(arg.declarator)
+    default = expression_text(arg.default, source)
+
+    if _untyped(arg.base_type) and not (name and arg.base_type.name):
+        # python argument, cython parses a lone name as a type without a declarator name
+        name = name or arg.base_type.name
+        if name == "self":
+            return ir.Arg("self")
+        annotation = annotation_type(arg.annotation) if arg.annotation is not None else None
+        return ir.Arg(name, annotation, default)
+
+    return ir.Arg(name, base_type(arg.base_type, pointers), default, True)
+
+
+class _Source:
+    """line offsets and raw text lookups of the prepared source"""
+
+    def __init__(self, code: str):
+        self.code = code
+        self.lines = code.split("\n")
+        self.offsets = [0]
+        for line in self.lines:
+            self.offsets.append(self.offsets[-1] + len(line) + 1)
+
+    def offset(self, node) -> int:
+        return self.offsets[node.pos[1] - 1] + node.pos[2]
+
+    def literal(self, node) -> Union[str, None]:
+        """string literal (ExprNode) as written in the source"""
+        match = string_literal.match(self.code, self.offset(node))
+        return match.group() if match is not None else None
+
+    def raw_doc(self, node, doc) -> str:
+        """docstring as written in the source, Cython only keeps the unescaped value"""
+
+        if not doc:
+            return ""
+
+        # the docstring is the first string after the header, before the first body statement
+        body = node.body.stats[0] if isinstance(node.body, Nodes.StatListNode) and node.body.stats else node.body
+        limit = self.offset(body) if body is not None and body.pos[1] > node.pos[1] else len(self.code)
+
+        header = self.offset(node)
+        colon = self.code.find(":\n", header, limit)
+        match = docstring_start.search(self.code, colon if colon != -1 else header, limit)
+        if match is None:
+            return str(doc)
+
+        end = self.code.find(match.group(1), match.end())
+        return self.code[match.end() : end] if end != -1 else str(doc)
+
+    def block(self, first_line: int, end: int) -> list:
+        """source lines from first_line to offset end, nested by indentation like IndentedBlock(restOfLine)"""
+
+        lines = [line for line in self.code[self.offsets[first_line - 1] : end].split("\n") if line.strip()]
+
+        def nest(lines: List[str]) -> list:
+            if not lines:
+                return []
+            indent = len(lines[0]) - len(lines[0].lstrip())
+            nested, i = [], 0
+            while i < len(lines):
+                if len(lines[i]) - len(lines[i].lstrip()) <= indent:
+                    nested.append(lines[i].strip())
+                    i += 1
+                    continue
+                j = i
+                while j < len(lines) and len(lines[j]) - len(lines[j].lstrip()) > indent:
+                    j += 1
+                nested.append(nest(lines[i:j]))
+                i = j
+            return nested
+
+        return nest(lines)
+
+
+def _stats(node) -> list:
+    if node is None:
+        return []
+    if isinstance(node, Nodes.StatListNode):
+        return [stat for child in node.stats for stat in _stats(child)]
+    return [node]
+
+
+def _name(node) -> str:
+    return expression_text(node)
+
+
+def _star_arg(stars: str, arg) -> ir.Arg:
+    annotation = annotation_type(arg.annotation) if arg.annotation is not None else None
+    return ir.Arg(f"{stars}{arg.name}", annotation)
+
+
+def build_function(node, source: _Source) -> ir.FunctionDef:
+    doc = source.raw_doc(node, node.doc)
+
+    if isinstance(node, Nodes.DefNode):
+        kwonly = node.num_kwonly_args
+        positional = node.args[: len(node.args) - kwonly]
+        args = [build_arg(arg, source) for arg in positional]
+        if node.star_arg is not None:
+            args.append(_star_arg("*", node.star_arg))
+        elif kwonly:
+            args.append(ir.Arg("*"))
+        args += [build_arg(arg, source) for arg in node.args[len(positional) :]]
+        if node.starstar_arg is not None:
+            args.append(_star_arg("**", node.starstar_arg))
+
+        returns = annotation_type(node.return_type_annotation) if node.return_type_annotation is not None else None
+        return ir.FunctionDef(node.name, args, returns, doc)
+
+    # cdef / cpdef, the declarator chain holds pointers of the return type, the name and the arguments
+    declarator, pointers = node.declarator, 0
+    while not isinstance(declarator, Nodes.CFuncDeclaratorNode):
+        pointers += isinstance(declarator, Nodes.CPtrDeclaratorNode)
+        declarator = declarator.base
+    name, _ = _declarator(declarator.base)
+
+    returns = None
+    if not (isinstance(node.base_type, Nodes.CSimpleBaseTypeNode) and node.base_type.name is None):
+        returns = base_type(node.base_type, pointers)
+
+    qualifier = "nogil" if declarator.nogil else ""
+    return ir.FunctionDef(name, [build_arg(arg, source) for arg in declarator.args], returns, doc, True, qualifier)
+
+
+def _members(body, source: _Source, cython: bool) -> List[ir.Node]:
+    members = []
+    for stat in _stats(body):
+        if isinstance(stat, (Nodes.DefNode, Nodes.CFuncDefNode)):
+            members.append(build_function(stat, source))
+        elif isinstance(stat, Nodes.PyClassDefNode) and not cython:
+            members.append(build_class(stat, source))
+    return members
+
+
+def build_class(node, source: _Source) -> Union[ir.ClassDef, ir.Enum]:
+    doc = source.raw_doc(node, node.doc)
+
+    if isinstance(node, Nodes.CClassDefNode):
+        bases = node.bases.args if node.bases is not None else []
+        parent = ", ".join(_name(base) for base in bases)
+        return ir.ClassDef(node.class_name, parent, doc, _members(node.body, source, True), cython=True)
+
+    bases = node.bases.args if isinstance(node.bases, ExprNodes.TupleNode) else []
+    parent = ", ".join(_name(base) for base in bases)
+
+    if parent == "Enum":
+        members = [source.lines[stat.pos[1] - 1].strip() for stat in _stats(node.body)]
+        return ir.Enum(node.name, parent, doc, members)
+
+    return ir.ClassDef(node.name, parent, doc, _members(node.body, source, False))
+
+
+def build_import(stat) -> Union[ir.Import, None]:
+    if isinstance(stat, Nodes.SingleAssignmentNode) and isinstance(stat.rhs, ExprNodes.ImportNode):
+        module = stat.rhs.module_name.value
+        alias = stat.lhs.name if stat.rhs.is_import_as_name else ""
+        return ir.Import("", [(module, alias)])
+
+    if isinstance(stat, Nodes.FromImportStatNode):
+        module = "." * (stat.module.level or 0) + stat.module.module_name.value
+        names = [(name, target.name if target.name != name else "") for name, target in stat.items]
+        return ir.Import(module, names)
+
+    if isinstance(stat, Nodes.CImportStatNode):
+        return ir.Import("", [(stat.module_name, stat.as_name or "")])
+
+    if isinstance(stat, Nodes.FromCImportStatNode):
+        module = "." * stat.relative_level + stat.module_name
+        return ir.Import(module, [(name, alias or "") for _, name, alias in stat.imported_names])
+
+    return None
+
+
+def _is_dataclass(node) -> bool:
+    return any(
+        isinstance(decorator.decorator, ExprNodes.NameNode) and decorator.decorator.name == "dataclass"
+        for decorator in node.decorators or []
+    )
+
+
+def _extern_declaration(stat) -> bool:
+    """named enums and structs with fields (not forward declarations) of an extern block"""
+
+    if isinstance(stat, Nodes.CStructOrUnionDefNode):
+        return stat.kind == "struct" and stat.attributes is not None
+    return isinstance(stat, Nodes.CEnumDefNode) and bool(stat.name)
+
+
+def build(stat, source: _Source, end: int, extern_declarations: bool = False) -> ir.Node:
+    """top level statement to its node, end is the offset of the next statement"""
+
+    if isinstance(stat, Nodes.CDefExternNode):
+        declarations = _stats(stat.body) if extern_declarations else []
+        body = [build(child, source, end) for child in declarations if _extern_declaration(child)]
+        return ir.Extern(stat.include_file or "", body)
+
+    if isinstance(stat, (Nodes.DefNode, Nodes.CFuncDefNode)):
+        return build_function(stat, source)
+
+    if isinstance(stat, Nodes.PyClassDefNode) and _is_dataclass(stat):
+        body = _stats(stat.body)
+        lines = source.block(body[0].pos[1], end) if body else []
+        return ir.Dataclass(stat.name, source.raw_doc(stat, stat.doc), lines)
+
+    if isinstance(stat, (Nodes.CClassDefNode, Nodes.PyClassDefNode)):
+        return build_class(stat, source)
+
+    if isinstance(stat, Nodes.CStructOrUnionDefNode):
+        fields = []
+        for attribute in stat.attributes or []:
+            for declarator in getattr(attribute, "declarators", []):
+                if _function_pointer(declarator):
+                    # like the grammar, fields without a python type are left out
+                    continue
+                name, pointers = _declarator(declarator)
+                fields.append((name, base_type(attribute.base_type, pointers)))
+        return ir.Struct(stat.name, "", fields)
+
+    if isinstance(stat, Nodes.CEnumDefNode) and stat.name:
+        return ir.Enum(stat.name, "Enum", members=[item.name for item in stat.items], cython=True)
+
+    if isinstance(stat, Nodes.CTypeDefNode):
+        name, pointers = _declarator(stat.declarator)
+        return ir.Typedef(name, base_type(stat.base_type, pointers))
+
+    return ir.Opaque(type(stat).__name__)
+
+
+def _statements(body, source: _Source) -> List[Tuple[object, int]]:
+    """
+    top level statements and their start offsets, statements of one line (import a, b) are kept together
+    decorated definitions start at their first decorator
+    """
+
+    statements = []
+    for child in body.stats if isinstance(body, Nodes.StatListNode) else [body]:
+        if isinstance(child, Nodes.StatListNode) and all(build_import(stat) is not None for stat in child.stats):
+            first = child.stats[0] if child.stats else child
+            statements.append((child, source.offsets[first.pos[1] - 1]))
+            continue
+
+        for stat in _stats(child):
+            line = min([stat.pos[1]] + [decorator.pos[1] for decorator in getattr(stat, "decorators", None) or []])
+            statements.append((stat, source.offsets[line - 1]))
+
+    return statements
+
+
+def _sectioned(nodes: List[Tuple[ir.Node, int, int]], source: _Source) -> Iterator[Tuple[ir.Node, int, int]]:
+    """consecutive imports and ctypedefs are one Section, like import_section and ctypedef_section"""
+
+    section, kind = None, None
+    for node, start, end in nodes:
+        node_kind = type(node) if isinstance(node, (ir.Import, ir.Typedef)) else None
+        between = source.code[section[2] : start] if section is not None else ""
+        comment = any(line.lstrip().startswith("#") for line in between.split("\n"))
+
+        if node_kind is not None and node_kind is kind and not comment:
+            section = (section[0], section[1], end)
+            section[0].body.append(node)
+            continue
+
+        if section is not None:
+            yield section
+            section, kind = None, None
+
+        if node_kind is not None:
+            section, kind = (ir.Section([node]), start, end), node_kind
+        else:
+            yield node, start, end
+
+    if section is not None:
+        yield section
+
+
+def ir_nodes(
+    prepared_code: str, skip_bodies: bool = False, extern_declarations: bool = False
+) -> Iterator[Tuple[ir.Node, int, int]]:
+    """
+    IR of the top level statements from Cython's own parser, spans tile the whole source
+    bodies are always parsed (skip_bodies has no effect), raises CythonSyntaxError on invalid source
+    """
+
+    source = _Source(prepared_code)
+    statements = _statements(parse_tree(prepared_code), source)
+
+    nodes = []
+    for i, (stat, start) in enumerate(statements):
+        end = statements[i + 1][1] if i + 1 < len(statements) else len(prepared_code)
+        start = 0 if i == 0 else start
+
+        if isinstance(stat, Nodes.StatListNode):
+            imports = [build_import(child) for child in stat.stats]
+            node = ir.Import(imports[0].module, [name for imp in imports for name in imp.names])
+        else:
+            node = build(stat, source, end, extern_declarations)
+            if isinstance(stat, (Nodes.SingleAssignmentNode, Nodes.FromImportStatNode, Nodes.CImportStatNode)):
+                node = build_import(stat) or node
+            elif isinstance(stat, Nodes.FromCImportStatNode):
+                node = build_import(stat)
+
+        nodes.append((node, start, end))
+
+    if not statements:
+        nodes.append((ir.Opaque("empty"), 0, len(prepared_code)))
+
+    yield from _sectioned(nodes, source)
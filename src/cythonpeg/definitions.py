@@ -20,15 +20,24 @@ from pyparsing import (
     LineEnd,
     SkipTo,
     IndentedBlock,
-    originalTextFor,
     restOfLine,
+    ParserElement,
+    ParseResults,
+    ParseException,
 )
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Dict, Iterator, List, Tuple, Union
+import re
 
 from cythonpeg.utilities import (
     parentheses_suppress,
     bracket_suppress,
     curl_suppress,
     EmptyDefault,
+    RawDefault,
+    SkipIndentedBlock,
+    substitute,
 )
 
 # LITERALS
@@ -139,9 +148,6 @@ arguments_definition = parentheses_suppress(DelimitedList(cython_argument_defini
     "arguments"
 )
 
-# recursive definitions
-recursive_definitions = Forward()
-
 # compiler directives
 DIRECTIVE = LineStart() + Literal("#") + SkipTo(LineEnd()) + LineEnd()
 directive_section = OneOrMore(DIRECTIVE)("directive_section")
@@ -165,8 +171,10 @@ external_declaration = Group(
     + EmptyDefault(external_directive)
     + Suppress(":")
 )("external_declaration")
-external_body = IndentedBlock(recursive_definitions, recursive=True)
-external_definition = (external_declaration + originalTextFor(external_body))("external")
+
+# extern blocks have no stub representation, the body is found by indentation alone
+external_body = SkipIndentedBlock()
+external_definition = (external_declaration + external_body)("external")
 
 # python class definition
 python_class_parent = Word(alphanums + "_" + ".")
@@ -174,17 +182,11 @@ python_class_arguments = parentheses_suppress(python_class_parent)
 python_class_decleration = Group(
     Suppress(CLASS) + VARIABLE + EmptyDefault(python_class_arguments) + Suppress(":"),
 )("class_decleration")
-python_class_body = IndentedBlock(recursive_definitions, recursive=True)
-python_class_definition = (python_class_decleration + Optional(docstring, default="") + python_class_body)("class")
 
 # python function definitions
 python_function_decleration = Group(
     Suppress(DEF) + VARIABLE + Group(arguments_definition) + Optional(python_return_definition, "") + Suppress(":")
 )("def_decleration")
-python_function_body = IndentedBlock(recursive_definitions, recursive=True)
-python_function_definition = (python_function_decleration + Optional(docstring, default="") + python_function_body)(
-    "def"
-)
 
 # cython function definition
 cython_function_decleration = Group(
@@ -195,21 +197,16 @@ cython_function_decleration = Group(
     + Optional(VARIABLE, default="")
     + Suppress(":")
 )("cdef_decleration")
-cython_function_body = IndentedBlock(recursive_definitions, recursive=True)
-cython_function_definition = (cython_function_decleration + Optional(docstring, default="") + cython_function_body)(
-    "cdef"
-)
 
 # cython class definition
 cython_class_decleration = Group(
     Suppress(CDEF + CLASS) + VARIABLE + EmptyDefault(python_class_arguments) + Suppress(":")
 )("cclass_decleration")
-cython_class_body = IndentedBlock(recursive_definitions, recursive=True)
-cython_class_definition = (cython_class_decleration + Optional(docstring, default="") + cython_class_body)("cclass")
 
 # cython struct definition
 cython_struct_decleration = Group(Suppress(CDEF + STRUCT) + VARIABLE + Suppress(":"))
-cython_struct_body = IndentedBlock(Group(type_definition + Group(DelimitedList(VARIABLE))), recursive=True)
+struct_field = Group(type_definition + Group(DelimitedList(VARIABLE)))
+cython_struct_body = IndentedBlock(struct_field, recursive=True)
 cython_struct_definition = (cython_struct_decleration + Optional(docstring, default="") + cython_struct_body)("cstruct")
 
 # dataclass definition
@@ -217,28 +214,222 @@ dataclass_decleration = Suppress(Literal("@") + DATACLASS + CLASS) + VARIABLE +
 dataclass_body = IndentedBlock(restOfLine, recursive=True)
 dataclass_definition = (dataclass_decleration + Optional(docstring, default="") + dataclass_body)("dataclass")
 
-# recursive definitions (could be individually assigned for parsing performance improvements: i.e cython_class never defined inside python_function)
-definitions = (
-    python_class_definition
-    | python_function_definition
-    | cython_class_definition
-    | cython_function_definition
-    | cython_struct_definition
-    | restOfLine
-)
-recursive_definitions << definitions
-
-# full recursive definition
-cython_parser = (
-    python_class_definition
-    | python_function_definition
-    | cython_class_definition
-    | cython_function_definition
-    | cython_struct_definition
-    | dataclass_definition
-    | import_section
-    | directive_section
-    | cenum_definition
-    | external_definition
-    | ctypedef_section
-)
+
+@lru_cache(maxsize=None)
+def build_cython_parser(skip_bodies: bool = False, raw_defaults: bool = False) -> ParserElement:
+    """
+    full recursive definition, skip_bodies matches function bodies by indentation instead of parsing them
+    raw_defaults captures default values as source text (RawDefault) instead of parsing them as EXPRESSION
+    """
+
+    if raw_defaults:
+        return substitute(build_cython_parser(skip_bodies), default_definition, (EQUALS + RawDefault())("default"))
+
+    # recursive definitions
+    recursive_definitions = Forward()
+
+    # function bodies are discarded by the stub, only class bodies hold member signatures
+    if skip_bodies:
+        python_function_body = SkipIndentedBlock()
+        cython_function_body = SkipIndentedBlock()
+    else:
+        python_function_body = IndentedBlock(recursive_definitions, recursive=True)
+        cython_function_body = IndentedBlock(recursive_definitions, recursive=True)
+
+    # python class definition
+    python_class_body = IndentedBlock(recursive_definitions, recursive=True)
+    python_class_definition = (python_class_decleration + Optional(docstring, default="") + python_class_body)("class")
+
+    # python function definitions
+    python_function_definition = (python_function_decleration + Optional(docstring, default="") + python_function_body)(
+        "def"
+    )
+
+    # cython function definition
+    cython_function_definition = (cython_function_decleration + Optional(docstring, default="") + cython_function_body)(
+        "cdef"
+    )
+
+    # cython class definition
+    cython_class_body = IndentedBlock(recursive_definitions, recursive=True)
+    cython_class_definition = (cython_class_decleration + Optional(docstring, default="") + cython_class_body)("cclass")
+
+    # recursive definitions (could be individually assigned for parsing performance improvements: i.e cython_class never defined inside python_function)
+    definitions = (
+        python_class_definition
+        | python_function_definition
+        | cython_class_definition
+        | cython_function_definition
+        | cython_struct_definition
+        | restOfLine
+    )
+    recursive_definitions << definitions
+
+    # full recursive definition
+    return (
+        python_class_definition
+        | python_function_definition
+        | cython_class_definition
+        | cython_function_definition
+        | cython_struct_definition
+        | dataclass_definition
+        | import_section
+        | directive_section
+        | cenum_definition
+        | external_definition
+        | ctypedef_section
+    )
+
+
+def __getattr__(name: str):
+    # cython_parser is built on first access
+    if name == "cython_parser":
+        return build_cython_parser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# leading keyword of a line -> top level definitions that can start with it
+dispatch_keywords = {
+    "class": ("class",),
+    "def": ("def",),
+    "async": ("def",),
+    "cdef": ("cclass", "cdef", "cstruct", "cenum", "external"),
+    "cpdef": ("cdef", "cenum"),
+    "@": ("dataclass",),
+    "import": ("import_section",),
+    "cimport": ("import_section",),
+    "from": ("import_section",),
+    "#": ("directive_section",),
+    "ctypedef": ("ctypedef_section",),
+}
+
+# keywords that only prefix a definition, scan_string matches the definition from the whitespace after them
+prefix_keywords = {"async"}
+
+leading_keyword = re.compile(r"[ \t\r\n]*([A-Za-z_]\w*|[@#])?")
+
+
+@lru_cache(maxsize=None)
+def build_dispatch_table(skip_bodies: bool = False, raw_defaults: bool = False) -> Dict[str, List[ParserElement]]:
+    """leading keyword -> top level definitions, in cython_parser precedence order"""
+
+    parser = build_cython_parser(skip_bodies, raw_defaults)
+    parser.streamline()
+
+    return {
+        keyword: [expr for expr in parser.exprs if expr.resultsName in names]
+        for keyword, names in dispatch_keywords.items()
+    }
+
+
+# line start, indentation and leading keyword
+line_keyword = re.compile(r"^([ \t]*)([A-Za-z_]\w*|[@#])", re.MULTILINE)
+
+# word or character a failed definition stopped at
+found_token = re.compile(r"\w+|\S")
+
+
+def resync_loc(instring: str, loc: int, indent: int, keywords: Dict[str, List[ParserElement]]) -> int:
+    """start of the first line after loc indented at most indent whose leading keyword can start a definition"""
+
+    for line in line_keyword.finditer(instring, loc):
+        if len(line.group(1)) <= indent and line.group(2) in keywords:
+            return line.start()
+    return len(instring)
+
+
+def dispatch_scan(
+    instring: str,
+    skip_bodies: bool = False,
+    recover: bool = False,
+    diagnostics: Union[List[Tuple[int, int, int, str]], None] = None,
+    raw_defaults: bool = False,
+) -> Iterator[Tuple[ParseResults, int, int]]:
+    """
+    cython_parser.scan_string replacement
+    definitions are only tried where the leading keyword of a line can start them
+    lines that no definition can start are skipped whole instead of one character at a time
+    recover: when the definitions a keyword starts all fail, skip to the next line that could start a definition
+    at the same or a lower indentation in its top level block (see segment_blocks), the body of the failed definition
+    is not scanned
+    the skipped (start, end, error location, reason) regions are appended to diagnostics
+    raw_defaults: see build_cython_parser
+    """
+
+    table = build_dispatch_table(skip_bodies, raw_defaults)
+    ParserElement.reset_cache()
+
+    # ends of the top level blocks (see segment_blocks), recover does not skip past the block of the failure
+    # so a source parsed block by block is skipped the same way
+    block_ends = None
+
+    loc = 0
+    while loc < len(instring):
+        keyword = leading_keyword.match(instring, loc)
+        token_loc = keyword.start(1)
+
+        if token_loc == -1:
+            # the line starts with a character no definition starts with
+            token_loc = keyword.end()
+            if token_loc >= len(instring):
+                break
+
+        # scan_string reports a match from the first location it succeeds at, which is the start
+        # of the whitespace before the keyword (or the start of its line for LineStart definitions)
+        candidates = table.get(keyword.group(1), [])
+        if keyword.group(1) in prefix_keywords:
+            starts = [keyword.end(1)]
+        else:
+            starts = [loc] + [i + 1 for i in range(loc, token_loc) if instring[i] == "\n"]
+
+        match = None
+        failure = None
+        for start in starts:
+            for expr in candidates:
+                try:
+                    end, tokens = expr._parse(instring, start)
+                except ParseException as e:
+                    if failure is None or e.loc > failure[1].loc:
+                        failure = expr.resultsName, e
+                    continue
+
+                if end > start:
+                    match = tokens, start, end
+                break
+
+            if match is not None:
+                break
+
+        if match is not None:
+            yield match
+            loc = match[2]
+            continue
+
+        # other decorators are not definitions, the line is skipped and the def or class below is parsed
+        decorator = keyword.group(1) == "@" and not instring.startswith("@dataclass", token_loc)
+
+        if recover and failure is not None and not decorator:
+            if block_ends is None:
+                from cythonpeg.segmenter import segment_blocks
+
+                block_ends = [end for _, end in segment_blocks(instring)]
+
+            indent = token_loc - (instring.rfind("\n", 0, token_loc) + 1)
+            line_end = instring.find("\n", token_loc)
+            loc = resync_loc(instring, len(instring) if line_end == -1 else line_end + 1, indent, table)
+            loc = min(loc, block_ends[bisect_right(block_ends, token_loc)])
+
+            if diagnostics is not None:
+                name, e = failure
+                found = found_token.search(instring, e.loc)
+                found = repr(found.group()) if found else "end of text"
+                end = token_loc + len(instring[token_loc:loc].rstrip())
+                diagnostics.append((token_loc, end, e.loc, f"{name}: {e.msg}, found {found}"))
+            continue
+
+        # resume at the whitespace that ends the line of the keyword
+        line_end = instring.find("\n", token_loc)
+        line_end = len(instring) if line_end == -1 else line_end
+        while line_end > token_loc + 1 and instring[line_end - 1] in " \t\r":
+            line_end -= 1
+        loc = line_end
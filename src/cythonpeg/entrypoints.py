@@ -1,38 +1,447 @@
+from __future__ import annotations
 import argparse
 from pathlib import Path
-from cythonpeg.tree2string import cython_string_2_stub
+from functools import partial
+from contextlib import nullcontext
+from cythonpeg.tree2string import (
+    Diagnostic,
+    StubConfig,
+    cython_string_2_report,
+    write_stub,
+    default_config,
+    set_engine,
+    set_error_recovery,
+    set_raw_defaults,
+    set_extern_declarations,
+    set_symbol_index,
+    set_type_converter_partial,
+    set_type_converter_complete,
+)
+from cythonpeg.segmenter import cython_string_2_report_blocks
+from cythonpeg.cache import StubCache
 import logging
+import filecmp
 import glob
-from typing import List
+import os
+import json
+from typing import Callable, IO, List, NamedTuple, Dict, Iterable, Iterator, TypeVar, Union, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+class StubResult(NamedTuple):
+    path: Path
+    unparsed: int
+    error: str
+    memoization: Dict[str, int]
+    cached: bool = False
+    written: bool = False
+    diagnostics: Tuple[Diagnostic, ...] = ()
+
+
+def write_if_changed(path: Path, text: str) -> bool:
+    """
+    replace path with text unless it already holds it, returns if the file was written
+    unchanged files keep their mtime, new content is renamed into place so readers never see a partial stub
+    """
+
+    try:
+        with open(path, "r") as file:
+            if file.read() == text:
+                return False
+    except (OSError, ValueError):
+        pass
+
+    _, written = stream_if_changed(path, lambda file: file.write(text))
+    return written
+
+
+def stream_if_changed(path: Path, write: Callable[[IO[str]], T]) -> Tuple[T, bool]:
+    """
+    write(file) into a temporary file next to path, renamed over path unless path already holds the same content
+    returns what write returned and if path was written, readers never see a partial file
+    """
+
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError:
+        mode = None
+
+    # created with the mode open() would use (umask applied), existing files keep theirs
+    tmp = path.with_name(f".{path.name}.{os.urandom(4).hex()}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "w") as file:
+            result = write(file)
+
+        # unchanged files keep their mtime
+        if mode is not None and filecmp.cmp(tmp, path, shallow=False):
+            os.unlink(tmp)
+            return result, False
+
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    return result, True
+
+
+def path_config(path: Path, config: Union[StubConfig, None] = None) -> StubConfig:
+    """config (default the set_* globals) for the stub of path, names defined in this file are left to its own stub"""
+    config = config or default_config()
+    if config.symbols is not None:
+        config = config._replace(symbols=config.symbols.for_file(path))
+    return config
+
+
+def log_diagnostics(path: Path, diagnostics: Iterable[Diagnostic]):
+    """log the regions of path skipped by error recovery"""
+    for diagnostic in diagnostics:
+        logger.warning(f"{path}:{diagnostic.line}: skipped to line {diagnostic.end_line}, {diagnostic.reason}")
+
+
+def stub_from_path(
+    path: Path,
+    cache: Union[StubCache, None] = None,
+    skip_bodies: bool = False,
+    executor: Union[Executor, None] = None,
+    config: Union[StubConfig, None] = None,
+    diagnostics: Union[List[Diagnostic], None] = None,
+) -> Tuple[int, bool, bool]:
+    """
+    write the .pyi stub next to path if its content changed
+    returns the number of unparsed characters, if the cache was hit and if the stub was written
+    executor: parse the top level blocks of the file concurrently
+    config: defaults to the set_* values
+    diagnostics: the regions skipped by error recovery are appended to it instead of being logged
+    """
 
-def stub_from_path(path: Path):
     with open(path, "r") as file:
         input_string = file.read()
 
-    stub_file, unparsed_characters = cython_string_2_stub(input_string)
+    config = path_config(path, config)
+    key = cache.key(input_string, config, skip_bodies=skip_bodies) if cache is not None else ""
+    entry = cache.get(key) if cache is not None else None
+
+    found = []
+    if entry is None and cache is None and executor is None:
+        # stream fragments into the stub file as they are parsed
+        (_, unparsed_characters, _), written = stream_if_changed(
+            path.with_suffix(".pyi"), lambda file: write_stub(input_string, file, skip_bodies, config, found)
+        )
+    else:
+        if entry is not None:
+            stub_file, unparsed_characters = entry
+        else:
+            if executor is not None:
+                report = cython_string_2_report_blocks(input_string, skip_bodies, executor=executor, config=config)
+            else:
+                report = cython_string_2_report(input_string, skip_bodies, config)
+            stub_file, unparsed_characters, found = report.stub, report.unparsed_text, report.diagnostics
 
-    if len(unparsed_characters):
-        logger.warning(f"{path}: {len(unparsed_characters)} unparsed charaters")
+        if entry is None and cache is not None:
+            cache.set(key, stub_file, unparsed_characters)
 
-    with open(path.with_suffix(".pyi"), "w") as file:
-        file.write(stub_file)
+        written = write_if_changed(path.with_suffix(".pyi"), stub_file)
 
+    if diagnostics is None:
+        log_diagnostics(path, found)
+    else:
+        diagnostics.extend(found)
+    return len(unparsed_characters), entry is not None, written
 
-def stubs_from_files(arguments: List[str]):
+
+def collect_paths(arguments: List[str]) -> List[Path]:
+    """expand globbed arguments into files, in argument order"""
+    paths = []
     for argument in arguments:
-        paths = glob.glob(argument)
-        for path in paths:
+        for path in glob.glob(argument):
             path = Path(path)
 
             if path.is_file():
-                stub_from_path(path)
+                paths.append(path)
+
+    return paths
+
+
+def _stub_job(
+    path: Path,
+    cache: Union[StubCache, None] = None,
+    skip_bodies: bool = False,
+    executor: Union[Executor, None] = None,
+    config: Union[StubConfig, None] = None,
+) -> StubResult:
+    from cythonpeg.utilities import memoization_stats
+
+    before = memoization_stats()
+
+    # returned with the result, workers do not log them
+    diagnostics = []
+    try:
+        unparsed, cached, written = stub_from_path(path, cache, skip_bodies, executor, config, diagnostics)
+        error = ""
+    except Exception as e:
+        unparsed, cached, written, error = 0, False, False, f"{type(e).__name__}: {e}"
+
+    after = memoization_stats()
+    memoization = {key: after[key] - before[key] for key in after}
+    return StubResult(path, unparsed, error, memoization, cached, written, tuple(diagnostics))
+
+
+def _init_worker(memoize_size: Union[int, None, bool]):
+    """process pool initializer, the grammar is built once per worker on import"""
+    from cythonpeg.utilities import enable_memoization
+
+    if memoize_size is not False:
+        enable_memoization(memoize_size)
+
+
+def generate_stubs(
+    paths: List[Path],
+    jobs: int = 1,
+    memoize_size: Union[int, None, bool] = False,
+    cache: Union[StubCache, None] = None,
+    skip_bodies: bool = False,
+    split_blocks: bool = False,
+) -> Iterator[StubResult]:
+    """
+    generate stubs for paths, results are yielded in path order
+    split_blocks: files are processed in order and the workers parse the top level blocks of each file
+    """
+
+    # resolved once here, workers started by spawn do not share the set_* globals
+    job = partial(_stub_job, cache=cache, skip_bodies=skip_bodies, config=default_config())
+
+    if jobs <= 1 or not paths or (len(paths) == 1 and not split_blocks):
+        for path in paths:
+            yield job(path)
+        return
+
+    # worker processes are only imported when used
+    from concurrent.futures import ProcessPoolExecutor
+    from cythonpeg.utilities import merge_memoization_stats
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(memoize_size,)) as executor:
+        if split_blocks:
+            for path in paths:
+                yield job(path, executor=executor)
+            return
+
+        chunksize = max(1, len(paths) // (jobs * 4))
+        for result in executor.map(job, paths, chunksize=chunksize):
+            merge_memoization_stats(result.memoization)
+            yield result
+
+
+def log_summary(results: List[StubResult]):
+    unparsed_files = 0
+    unparsed_total = 0
+    failed = 0
+    cached = 0
+    written = 0
+
+    for result in results:
+        if result.error:
+            failed += 1
+            logger.error(f"{result.path}: {result.error}")
+            continue
+
+        cached += result.cached
+        written += result.written
+        log_diagnostics(result.path, result.diagnostics)
+        if result.unparsed:
+            unparsed_files += 1
+            unparsed_total += result.unparsed
+            logger.warning(f"{result.path}: {result.unparsed} unparsed charaters")
+
+    logger.info(
+        f"{len(results)} files ({cached} cached), {written} written, {len(results) - written - failed} unchanged, "
+        f"{unparsed_total} unparsed charaters in {unparsed_files} files, {failed} failed"
+    )
+
+
+def stubs_from_files(
+    arguments: List[str],
+    jobs: int = 1,
+    memoize_size: Union[int, None, bool] = False,
+    cache: Union[StubCache, None] = None,
+    skip_bodies: bool = False,
+    split_blocks: bool = False,
+):
+    results = list(generate_stubs(collect_paths(arguments), jobs, memoize_size, cache, skip_bodies, split_blocks))
+    log_summary(results)
+
+    if cache is not None:
+        cache.evict()
+
+    return results
+
+
+def log_memoization_stats():
+    from cythonpeg.utilities import memoization_stats
+
+    stats = memoization_stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = 100 * stats["hits"] / lookups if lookups else 0.0
+    logger.info(f"memoization: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.1f}% hit rate)")
 
 
 def entrypoint():
     parser = argparse.ArgumentParser(description="Generate stubs from cython files")
-    parser.add_argument("paths", nargs="+", help="File or Directory (wildcards supported)")
+    parser.add_argument("paths", nargs="*", help="File or Directory (wildcards supported)")
+    parser.add_argument("--memoize", action="store_true", help="enable packrat memoization of the grammar")
+    parser.add_argument(
+        "--memoize-size", type=int, default=128, help="packrat cache entries (0 for an unbounded cache, default 128)"
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes (default 1)")
+    parser.add_argument("--no-cache", action="store_true", help="always parse, bypassing the stub cache")
+    parser.add_argument("--clear-cache", action="store_true", help="remove all stub cache entries before running")
+    parser.add_argument(
+        "--cache-dir", type=Path, default=None, help="stub cache directory (default ~/.cache/cythonpeg)"
+    )
+    parser.add_argument("--cache-size", type=int, default=64, help="stub cache size limit in MB (default 64)")
+    parser.add_argument(
+        "--skip-bodies", action="store_true", help="find function bodies by indentation instead of parsing them"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=("pyparsing", "cython"),
+        default="pyparsing",
+        help="parser building the stubs: the cythonpeg grammar or Cython's own parser (default pyparsing)",
+    )
+    parser.add_argument(
+        "--recover",
+        action="store_true",
+        help="skip definitions that fail to parse to the next line that can start one, logging why they failed",
+    )
+    parser.add_argument(
+        "--raw-defaults",
+        action="store_true",
+        help="copy default values from the source as written instead of parsing them (faster)",
+    )
+    parser.add_argument(
+        "--extern-declarations",
+        action="store_true",
+        help="add the structs and enums declared in cdef extern from blocks to the stub",
+    )
+    parser.add_argument(
+        "--split-blocks",
+        action="store_true",
+        help="parse the top level blocks of each file in parallel instead of whole files (for few large files)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print per grammar element and emitter counts and times (serial, no cache)",
+    )
+    parser.add_argument("--profile-json", type=Path, default=None, help="write the profile as json to this path")
+    parser.add_argument(
+        "--type-map",
+        default=None,
+        help='type conversion table: "standard" (libc and numpy) or a json file with exact, prefixes and memoryview',
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="resolve ctypedefs, structs and enums defined in the other .pyx/.pxd files below the common "
+        "directory of paths",
+    )
+    parser.add_argument(
+        "--watch",
+        type=Path,
+        default=None,
+        metavar="DIR",
+        help="keep running, regenerate stubs of .pyx files that change",
+    )
+    parser.add_argument("--poll", action="store_true", help="watch by polling instead of inotify")
+    parser.add_argument(
+        "--debounce", type=float, default=0.1, help="seconds without changes before a watched file is regenerated"
+    )
     args = parser.parse_args()
-    stubs_from_files(args.paths)
+
+    if not args.paths and args.watch is None:
+        parser.error("paths or --watch DIR are required")
+
+    logging.basicConfig(level=logging.INFO)
+    set_engine(args.engine)
+    set_error_recovery(args.recover)
+    set_raw_defaults(args.raw_defaults)
+    set_extern_declarations(args.extern_declarations)
+
+    cache = StubCache(args.cache_dir, args.cache_size * 2**20)
+    if args.clear_cache:
+        cache.clear()
+    if args.no_cache:
+        cache = None
+
+    memoize_size = (args.memoize_size or None) if args.memoize else False
+    if args.memoize:
+        from cythonpeg.utilities import enable_memoization
+
+        enable_memoization(memoize_size)
+
+    type_map = None
+    if args.type_map is not None:
+        from cythonpeg.typemap import TypeMap, standard_type_map
+
+        type_map = standard_type_map() if args.type_map == "standard" else TypeMap.from_json(args.type_map)
+        set_type_converter_partial(type_map.partial)
+        set_type_converter_complete(type_map.complete)
+
+    if args.index:
+        from cythonpeg.symbols import build_symbol_index, project_root, project_sources
+
+        paths = collect_paths(args.paths)
+        root = args.watch if args.watch is not None else project_root(paths) if paths else None
+        sources = project_sources(root) if root is not None else []
+        set_symbol_index(build_symbol_index(sources, args.jobs, cache))
+        logger.info(f"indexed {len(sources)} files")
+
+    if args.watch is not None:
+        from cythonpeg.watch import watch
+
+        logger.info(f"watching {args.watch}")
+        try:
+            watch(args.watch, cache, args.skip_bodies, args.debounce, poll=args.poll)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    profiler = None
+    if args.profile or args.profile_json:
+        from cythonpeg.profiling import GrammarProfiler
+
+        profiler = GrammarProfiler()
+
+        # profiled parsing happens in this process and every file is parsed
+        cache, args.jobs = None, 1
+
+    with profiler or nullcontext():
+        results = stubs_from_files(args.paths, args.jobs, memoize_size, cache, args.skip_bodies, args.split_blocks)
+
+    if args.profile:
+        print(profiler.table())
+    if args.profile_json:
+        with open(args.profile_json, "w") as file:
+            json.dump(profiler.as_dict(), file, indent=2)
+
+    if args.memoize:
+        log_memoization_stats()
+    if type_map is not None and args.jobs <= 1:
+        stats = type_map.stats()
+        logger.info(
+            f"type map: {stats['partial']['hit_rate']:.1f}% partial, "
+            f"{stats['complete']['hit_rate']:.1f}% complete hit rate"
+        )
+
+    if any(result.error for result in results):
+        raise SystemExit(1)
@@ -0,0 +1,78 @@
+from typing import Iterator, List, Tuple
+import re
+from cythonpeg import ir
+
+# struct / enum header inside an extern block, cdef is optional there
+declaration_header = re.compile(
+    r"(?:(?:cdef|ctypedef|cpdef)\s+)?(?:packed\s+)?(struct|enum)\s+([A-Za-z_]\w*)\s*:\s*(?:#.*)?$"
+)
+enum_member = re.compile(r"\s*([A-Za-z_]\w*)\s*(?:=.*)?$")
+qualifiers = re.compile(r"\b(?:const|volatile)\s+")
+
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip())
+
+
+def _code(line: str) -> str:
+    # declarations hold no strings, a # always starts a comment
+    return line.split("#", 1)[0].rstrip()
+
+
+def _blocks(lines: List[str]) -> Iterator[Tuple[str, str, List[str]]]:
+    """(kind, name, body lines) of the struct and enum declarations, other lines are skipped by indentation"""
+
+    i = 0
+    while i < len(lines):
+        header = declaration_header.match(lines[i].strip())
+        indent = _indent(lines[i])
+        i += 1
+        if header is None:
+            continue
+
+        body = []
+        while i < len(lines) and (not _code(lines[i]).strip() or _indent(lines[i]) > indent):
+            if _code(lines[i]).strip():
+                body.append(_code(lines[i]))
+            i += 1
+
+        yield header.group(1), header.group(2), body
+
+
+def _struct(name: str, body: List[str]) -> ir.Struct:
+    # fields are parsed like the fields of a cdef struct, fields the grammar rejects (function pointers) are left out
+    from cythonpeg.definitions import struct_field
+    from pyparsing import ParseException
+
+    fields = []
+    for line in body:
+        try:
+            type_tree, names = struct_field.parse_string(qualifiers.sub("", line.strip()), parse_all=True)[0]
+        except ParseException:
+            continue
+        fields.extend((field, ir.build_type(type_tree)) for field in names)
+
+    return ir.Struct(name, "", fields)
+
+
+def _enum(name: str, body: List[str]) -> ir.Enum:
+    members = []
+    for line in body:
+        for item in line.split(","):
+            member = enum_member.match(item)
+            if member is not None:
+                members.append(member.group(1))
+
+    return ir.Enum(name, "Enum", members=members, cython=True)
+
+
+def extern_declarations(block: str) -> List[ir.Node]:
+    """
+    structs and enums declared in the source of a cdef extern from block, found by indentation
+    the rest of the block (functions, variables) is skipped without parsing
+    """
+
+    declarations = []
+    for kind, name, body in _blocks(block.split("\n")[1:]):
+        declarations.append(_struct(name, body) if kind == "struct" else _enum(name, body))
+    return declarations
@@ -0,0 +1,341 @@
+from __future__ import annotations
+from typing import List, Tuple, Union, TYPE_CHECKING
+
+# builders only read ParseResults, pyparsing is not imported here
+if TYPE_CHECKING:
+    from pyparsing import ParseResults
+
+
+class Node:
+    """
+    intermediate representation between the parse tree and the emitters
+    nodes hold str, lists and other nodes only, they compare by value and pickle
+    types are stored as written, the type converters are applied when emitting
+    """
+
+    __slots__ = ()
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({', '.join(repr(value) for value in self._values())})"
+
+
+class Type(Node):
+    """name[args]=default"""
+
+    __slots__ = ("name", "args", "default")
+
+    def __init__(self, name: str, args: List[Type] = None, default: str = ""):
+        self.name = name
+        self.args = args or []
+        self.default = default
+
+
+class Arg(Node):
+    """python argument (name: type=default) or cython argument (type name = default)"""
+
+    __slots__ = ("name", "type", "default", "cython")
+
+    def __init__(self, name: str, type: Union[Type, None] = None, default: str = "", cython: bool = False):
+        self.name = name
+        self.type = type
+        self.default = default
+        self.cython = cython
+
+
+class FunctionDef(Node):
+    """def, cdef and cpdef functions, qualifier is the trailing nogil/except word of cython functions"""
+
+    __slots__ = ("name", "args", "returns", "doc", "cython", "qualifier")
+
+    def __init__(
+        self,
+        name: str,
+        args: List[Arg],
+        returns: Union[Type, None] = None,
+        doc: str = "",
+        cython: bool = False,
+        qualifier: str = "",
+    ):
+        self.name = name
+        self.args = args
+        self.returns = returns
+        self.doc = doc
+        self.cython = cython
+        self.qualifier = qualifier
+
+
+class ClassDef(Node):
+    """python class or cdef class, body holds the members that appear in the stub"""
+
+    __slots__ = ("name", "parent", "doc", "body", "cython")
+
+    def __init__(self, name: str, parent: str = "", doc: str = "", body: List[Node] = None, cython: bool = False):
+        self.name = name
+        self.parent = parent
+        self.doc = doc
+        self.body = body or []
+        self.cython = cython
+
+
+class Enum(Node):
+    """python Enum subclass (members are source lines) or cython enum (members are names)"""
+
+    __slots__ = ("name", "parent", "doc", "members", "cython")
+
+    def __init__(self, name: str, parent: str, doc: str = "", members: List[str] = None, cython: bool = False):
+        self.name = name
+        self.parent = parent
+        self.doc = doc
+        self.members = members or []
+        self.cython = cython
+
+
+class Struct(Node):
+    """cdef struct, one (name, type) field per declared name"""
+
+    __slots__ = ("name", "doc", "fields")
+
+    def __init__(self, name: str, doc: str = "", fields: List[Tuple[str, Type]] = None):
+        self.name = name
+        self.doc = doc
+        self.fields = fields or []
+
+
+class Dataclass(Node):
+    """@dataclass class, body is kept as source lines (nested lists for indented blocks)"""
+
+    __slots__ = ("name", "doc", "body")
+
+    def __init__(self, name: str, doc: str, body: list):
+        self.name = name
+        self.doc = doc
+        self.body = body
+
+
+class Import(Node):
+    """import names or from module import names, names are (name, alias) pairs"""
+
+    __slots__ = ("module", "names")
+
+    def __init__(self, module: str, names: List[Tuple[str, str]]):
+        self.module = module
+        self.names = names
+
+
+class Typedef(Node):
+    """ctypedef type name"""
+
+    __slots__ = ("name", "type")
+
+    def __init__(self, name: str, type: Type):
+        self.name = name
+        self.type = type
+
+
+class Section(Node):
+    """consecutive imports or ctypedefs"""
+
+    __slots__ = ("body",)
+
+    def __init__(self, body: List[Node]):
+        self.body = body
+
+
+class Extern(Node):
+    """cdef extern from header, body holds the structs and enums of the declaration pass (empty otherwise)"""
+
+    __slots__ = ("header", "body")
+
+    def __init__(self, header: str, body: List[Node] = None):
+        self.header = header
+        self.body = body or []
+
+
+class Opaque(Node):
+    """top level definition without a stub representation (directives)"""
+
+    __slots__ = ("kind",)
+
+    def __init__(self, kind: str):
+        self.kind = kind
+
+
+class Module(Node):
+    """top level nodes of a source and their (start, end) spans in the prepared source"""
+
+    __slots__ = ("body", "spans")
+
+    def __init__(self, body: List[Node] = None, spans: List[Tuple[int, int]] = None):
+        self.body = body or []
+        self.spans = spans or []
+
+
+def expression_text(expression: Union[ParseResults, str]) -> str:
+    """EXPRESSION parsed tree to source text"""
+
+    if isinstance(expression, str):
+        return expression
+
+    name = expression.getName()
+    if name == "list":
+        return "[" + ", ".join(expression_text(e) for e in expression) + "]"
+    if name == "set":
+        return "{" + ", ".join(expression_text(e) for e in expression) + "}"
+    if name == "tuple":
+        return "(" + ", ".join(expression_text(e) for e in expression) + ")"
+    if name == "dict":
+        return "{" + ", ".join(f"{expression_text(k)} : {expression_text(v)}" for k, v in expression) + "}"
+
+    return "".join(expression_text(e) for e in expression)
+
+
+def build_type(type_tree: ParseResults) -> Type:
+    """type_definition parsed tree to Type"""
+
+    type_name, type_bracket, type_default = type_tree
+    args = [build_type(arg) for arg in type_bracket] if type_bracket else []
+    return Type(type_name, args, expression_text(type_default) if type_default else "")
+
+
+def build_arg(arg: ParseResults) -> Arg:
+    """python_argument_definition or cython_argument_definition parsed tree to Arg"""
+
+    if arg[0] == "self":
+        return Arg("self")  # handle unique case cdef inside class
+
+    if arg.getName() == "cython_argument":
+        arg_type, arg_name, arg_default = arg
+        return Arg(arg_name, build_type(arg_type), expression_text(arg_default) if arg_default else "", True)
+
+    arg_name, arg_type, arg_default = arg
+    arg_type = build_type(arg_type) if not isinstance(arg_type, str) else None
+    return Arg(arg_name, arg_type, expression_text(arg_default) if arg_default else "")
+
+
+def build_def(result: ParseResults) -> FunctionDef:
+    """function_definition parsed tree to FunctionDef"""
+
+    decleration, docs, body = result
+    name, args, ret = decleration
+    return FunctionDef(name, [build_arg(arg) for arg in args], build_type(ret) if ret else None, docs)
+
+
+def build_cdef(result: ParseResults) -> FunctionDef:
+    """cython_function_definition parsed tree to FunctionDef"""
+
+    decleration, docs, body = result
+    ret, name, args, gil = decleration
+    return FunctionDef(name, [build_arg(arg) for arg in args], build_type(ret) if ret else None, docs, True, gil)
+
+
+def _members(body: ParseResults, builders: dict) -> List[Node]:
+    members = []
+    for i, b in enumerate(body):
+        if isinstance(b, str):
+            continue
+
+        builder = builders.get(b.getName())
+        if builder is not None:
+            members.append(builder((b, body[i + 1], body[i + 2])))
+
+    return members
+
+
+def build_class(result: ParseResults) -> Union[ClassDef, Enum]:
+    """python_class_definition parsed tree to ClassDef (Enum for Enum subclasses)"""
+
+    decleration, docs, body = result
+    name, parent = decleration
+
+    if parent == "Enum":
+        return Enum(name, parent, docs, [b for b in body if isinstance(b, str)])
+
+    members = {"class_decleration": build_class, "def_decleration": build_def, "cdef_decleration": build_cdef}
+    return ClassDef(name, parent, docs, _members(body, members))
+
+
+def build_cclass(result: ParseResults) -> ClassDef:
+    """cython_class_definition parsed tree to ClassDef"""
+
+    decleration, docs, body = result
+    name, parent = decleration
+
+    members = {"cclass_decleration": build_cclass, "def_decleration": build_def, "cdef_decleration": build_cdef}
+    return ClassDef(name, parent, docs, _members(body, members), cython=True)
+
+
+def build_cenum(result: ParseResults) -> Enum:
+    """enum_definition parsed tree to Enum"""
+
+    name, body = result
+    return Enum(name[0], "Enum", members=[member[0] for member in body], cython=True)
+
+
+def build_struct(result: ParseResults) -> Struct:
+    """cython_struct_definition parsed tree to Struct"""
+
+    decleration, docs, body = result
+    return Struct(decleration[0], docs, [(name, build_type(type_tree)) for type_tree, names in body for name in names])
+
+
+def _lines(body: ParseResults) -> list:
+    return [b if isinstance(b, str) else _lines(b) for b in body]
+
+
+def build_dataclass(result: ParseResults) -> Dataclass:
+    """dataclass_definition parsed tree to Dataclass"""
+
+    name, docs, body = result
+    return Dataclass(name, docs, _lines(body))
+
+
+def build_import(result: ParseResults) -> Import:
+    """import_definition or from_import_defintion parsed tree to Import"""
+
+    if len(result) == 1:
+        return Import("", [(name, alias) for name, alias in result[0]])
+    return Import(result[0], [(name, alias) for name, alias in result[1]])
+
+
+def build_import_section(result: ParseResults) -> Section:
+    return Section([build_import(imp) for imp in result])
+
+
+def build_ctypedef_section(result: ParseResults) -> Section:
+    return Section([Typedef(name, build_type(type_tree)) for type_tree, name in result])
+
+
+def build_external(result: ParseResults) -> Extern:
+    """external_definition parsed tree to Extern, the body is skipped by the grammar"""
+
+    decleration, _ = result
+    return Extern(decleration[0])
+
+
+# top level result name -> builder
+builders = {
+    "def": build_def,
+    "cdef": build_cdef,
+    "class": build_class,
+    "cenum": build_cenum,
+    "cclass": build_cclass,
+    "cstruct": build_struct,
+    "dataclass": build_dataclass,
+    "import_section": build_import_section,
+    "ctypedef_section": build_ctypedef_section,
+    "external": build_external,
+}
+
+
+def build(result: ParseResults) -> Node:
+    """top level parsed tree to its node"""
+
+    name = result.get_name()
+    builder = builders.get(name)
+    return builder(result) if builder is not None else Opaque(name or "")
@@ -0,0 +1,162 @@
+from pyparsing import ParserElement, ParseBaseException, IndentedBlock
+from typing import Callable, Dict, Tuple, Union
+from functools import wraps
+import time
+from cythonpeg import definitions
+from cythonpeg import tree2string
+from cythonpeg.utilities import SkipIndentedBlock, _children
+
+
+class ProfileStats:
+    """counters of one grammar element or emitter, seconds include nested elements"""
+
+    __slots__ = ("attempts", "successes", "failures", "seconds", "active")
+
+    def __init__(self):
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        self.seconds = 0.0
+        # recursive calls in progress, only the outermost call adds time
+        self.active = 0
+
+    def as_dict(self) -> Dict[str, Union[int, float]]:
+        return {
+            "attempts": self.attempts,
+            "successes": self.successes,
+            "failures": self.failures,
+            "seconds": self.seconds,
+        }
+
+
+def grammar_elements() -> Dict[int, Tuple[str, ParserElement]]:
+    """
+    named elements of all grammars (id -> (label, element))
+    module level elements by variable name, top level alternatives by result name and
+    indented blocks by the nearest named element containing them
+    the raw_defaults grammars are copies, their elements are labeled by alternative and indented block only
+    """
+
+    labels = {}
+    for name, value in vars(definitions).items():
+        if isinstance(value, ParserElement) and not name.startswith("_"):
+            labels.setdefault(id(value), (name, value))
+
+    for skip_bodies, raw_defaults in ((False, False), (True, False), (False, True), (True, True)):
+        parser = definitions.build_cython_parser(skip_bodies, raw_defaults)
+        stack = [(parser, "cython_parser")]
+        for alternatives in definitions.build_dispatch_table(skip_bodies, raw_defaults).values():
+            for alternative in alternatives:
+                labels.setdefault(id(alternative), (f"alternative {alternative.resultsName}", alternative))
+
+        seen = set()
+        while stack:
+            element, parent = stack.pop()
+            if id(element) in seen:
+                continue
+            seen.add(id(element))
+
+            if id(element) not in labels and isinstance(element, (IndentedBlock, SkipIndentedBlock)):
+                labels[id(element)] = (f"{type(element).__name__} in {parent}", element)
+
+            label = labels[id(element)][0] if id(element) in labels else parent
+            stack.extend((child, label) for child in _children(element))
+
+    return labels
+
+
+class GrammarProfiler:
+    """
+    attempts, successes, failures and cumulative time of named grammar elements and of the
+    tree2string emitters, active inside the with block
+    parseImpl of each element is wrapped, packrat cache hits do not reach it and are not counted
+    """
+
+    def __init__(self):
+        self.elements: Dict[str, ProfileStats] = {}
+        self.emitters: Dict[str, ProfileStats] = {}
+        self._restore_elements = []
+        self._restore_emitters = {}
+        self._restore_constructors = {}
+
+    @staticmethod
+    def _timed(stats: ProfileStats, function: Callable, exceptions=(Exception,)) -> Callable:
+        @wraps(function)
+        def timed(*args, **kwargs):
+            stats.attempts += 1
+            stats.active += 1
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except exceptions:
+                stats.failures += 1
+                raise
+            finally:
+                stats.active -= 1
+                if not stats.active:
+                    stats.seconds += time.perf_counter() - start
+            stats.successes += 1
+            return result
+
+        return timed
+
+    def start(self):
+        for label, element in grammar_elements().values():
+            stats = self.elements.setdefault(label, ProfileStats())
+            # instance attribute shadows the class parseImpl, parse failures are exceptions
+            self._restore_elements.append(element)
+            element.parseImpl = self._timed(stats, element.parseImpl, (ParseBaseException, IndexError))
+
+        # emitters call each other through module globals, wrapping the globals times nested calls too
+        for name, value in vars(tree2string).items():
+            if callable(value) and (name.endswith("2str") or name == "recursive_body"):
+                self._restore_emitters[name] = value
+                setattr(tree2string, name, self._timed(self.emitters.setdefault(name, ProfileStats()), value))
+
+        for key, emitter in tree2string.string_constructor.items():
+            self._restore_constructors[key] = emitter
+            tree2string.string_constructor[key] = getattr(tree2string, emitter.__name__)
+
+    def stop(self):
+        for element in self._restore_elements:
+            del element.parseImpl
+        for name, emitter in self._restore_emitters.items():
+            setattr(tree2string, name, emitter)
+        tree2string.string_constructor.update(self._restore_constructors)
+
+        self._restore_elements = []
+        self._restore_emitters = {}
+        self._restore_constructors = {}
+
+    def __enter__(self) -> "GrammarProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def as_dict(self) -> Dict[str, Dict[str, Dict[str, Union[int, float]]]]:
+        """json serializable stats of the elements and emitters that were attempted"""
+        return {
+            "elements": {name: stats.as_dict() for name, stats in self.elements.items() if stats.attempts},
+            "emitters": {name: stats.as_dict() for name, stats in self.emitters.items() if stats.attempts},
+        }
+
+    def table(self, sort: str = "seconds", limit: Union[int, None] = None) -> str:
+        """stats sorted by descending sort key (seconds, attempts, successes, failures)"""
+
+        lines = []
+        for title, stats in (("element", self.elements), ("emitter", self.emitters)):
+            rows = sorted(
+                ((name, s) for name, s in stats.items() if s.attempts),
+                key=lambda row: getattr(row[1], sort),
+                reverse=True,
+            )[:limit]
+            width = max([len(title)] + [len(name) for name, _ in rows])
+
+            lines.append(f"{title:<{width}} {'attempts':>10} {'successes':>10} {'failures':>10} {'seconds':>10}")
+            for name, s in rows:
+                lines.append(f"{name:<{width}} {s.attempts:>10} {s.successes:>10} {s.failures:>10} {s.seconds:>10.4f}")
+            lines.append("")
+
+        return "\n".join(lines)
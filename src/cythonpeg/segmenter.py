@@ -0,0 +1,313 @@
+from __future__ import annotations
+from functools import partial
+import hashlib
+import os
+import re
+from typing import Dict, Iterable, Iterator, List, Tuple, Union, TYPE_CHECKING
+from cythonpeg.tree2string import (
+    StubConfig,
+    StubFragment,
+    StubReport,
+    default_config,
+    diagnostic,
+    prepare_source,
+    unparsed_regions,
+    _stub_fragments,
+)
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+# definitions that OneOrMore merges across consecutive lines
+SECTION_KINDS = {"import": "import", "cimport": "import", "from": "import", "ctypedef": "ctypedef", "#": "#"}
+
+OPEN_BRACKETS = "([{"
+CLOSE_BRACKETS = ")]}"
+
+# leading keyword, "@" or "#" of a line
+LEADING_KIND = re.compile(r"\s*([@#]|\w*)")
+# characters that change the bracket, string or comment state of a line
+SPECIAL = re.compile("[#'\"" + re.escape(OPEN_BRACKETS + CLOSE_BRACKETS) + "]")
+QUOTE_END = {quote: re.compile(r"\\|" + re.escape(quote)) for quote in ("'", '"', "'''", '"""')}
+
+
+def _leading_kind(line: str) -> str:
+    """leading keyword of a line ("@" and "#" for decorators and comments)"""
+
+    return LEADING_KIND.match(line).group(1)
+
+
+def segment_blocks(prepared_code: str) -> List[Tuple[int, int]]:
+    """
+    split prepared source into top level blocks that parse independently of each other
+    blocks start at column 0 statements, a boundary is never placed:
+    - inside brackets, strings or after a backslash continuation
+    - after a decorator
+    - between consecutive statements OneOrMore merges into one section (imports, directives, ctypedefs)
+    after a block header (':') followed by a column 0 line IndentedBlock anchors at column 1
+    and takes every following line, the rest of the source is then a single block
+    """
+
+    boundaries = [0]
+
+    depth = 0
+    quote = ""
+    backslash = False
+    statement_kind = ""
+    statement_colon = False
+    last_colon = False
+
+    loc = 0
+    while loc < len(prepared_code):
+        line_end = prepared_code.find("\n", loc)
+        line_end = len(prepared_code) if line_end == -1 else line_end
+        line = prepared_code[loc:line_end]
+
+        logical_start = not quote and depth == 0 and not backslash
+        kind = _leading_kind(line) if line.strip() else ""
+
+        if logical_start and kind and loc > 0 and not line[0].isspace():
+            starts_statement = kind[0].isalpha() or kind[0] in "_@#"
+
+            if statement_colon:
+                # IndentedBlock anchored at column 1, no further boundaries
+                break
+
+            if (
+                starts_statement
+                and statement_kind != "@"
+                and not (kind in SECTION_KINDS and SECTION_KINDS.get(statement_kind) == SECTION_KINDS[kind])
+            ):
+                boundaries.append(loc)
+
+        if logical_start and kind:
+            statement_kind = kind
+
+        # track strings, comments and brackets to the end of the line, jumping between the characters that matter
+        backslash = False
+        i = 0
+        while True:
+            if quote:
+                match = QUOTE_END[quote].search(line, i)
+                if match is None:
+                    break
+                if match.group() == "\\":
+                    # escaped character
+                    i = match.start() + 2
+                    continue
+                i = match.end()
+                quote = ""
+                last_colon = False
+                continue
+
+            match = SPECIAL.search(line, i)
+            code = line[i : match.start() if match is not None else len(line)].rstrip()
+            if code:
+                last_colon = code[-1] == ":"
+            if match is None:
+                break
+
+            char = match.group()
+            if char == "#":
+                break
+            if char in "\"'":
+                quote = line[match.start() : match.start() + 3]
+                quote = quote if quote in ('"""', "'''") else char
+                i = match.start() + len(quote)
+                continue
+            if char in OPEN_BRACKETS:
+                depth += 1
+            else:
+                depth = max(depth - 1, 0)
+            last_colon = False
+            i = match.end()
+
+        if quote in ("'", '"'):
+            # unterminated single line string
+            quote = ""
+
+        if line.rstrip().endswith("\\") and not line.lstrip().startswith("#"):
+            backslash = True
+
+        if not quote and depth == 0 and not backslash and line.strip():
+            statement_colon = last_colon
+
+        loc = line_end + 1
+
+    boundaries.append(len(prepared_code))
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def block_fragments(
+    block: Tuple[int, str], skip_bodies: bool = False, config: Union[StubConfig, None] = None
+) -> Tuple[List[StubFragment], List[Tuple[int, int, int, str]]]:
+    """parse one block, spans and regions skipped by error recovery are returned relative to the full source"""
+
+    offset, block_code = block
+
+    # IndentedBlock needs newline as sentinal
+    if not block_code.endswith("\n"):
+        block_code += "\n"
+
+    skipped = []
+    fragments = [
+        StubFragment(fragment.text, offset + fragment.start, offset + fragment.end)
+        for fragment in _stub_fragments(block_code, skip_bodies, config, skipped)
+    ]
+    return fragments, [(offset + start, offset + end, offset + error, reason) for start, end, error, reason in skipped]
+
+
+def _pooled_block_fragments(
+    block: Tuple[int, str], skip_bodies: bool = False, config: Union[StubConfig, None] = None
+) -> Tuple[Tuple[List[StubFragment], List[Tuple[int, int, int, str]]], Dict[str, int]]:
+    """block_fragments in a worker process, with the packrat statistics it recorded there"""
+    from cythonpeg.utilities import memoization_stats
+
+    before = memoization_stats()
+    result = block_fragments(block, skip_bodies, config)
+    after = memoization_stats()
+    return result, {key: after[key] - before[key] for key in after}
+
+
+def _merge_stats(pooled: Iterable) -> Iterator[Tuple[List[StubFragment], List[Tuple[int, int, int, str]]]]:
+    from cythonpeg.utilities import merge_memoization_stats
+
+    for result, stats in pooled:
+        merge_memoization_stats(stats)
+        yield result
+
+
+def cython_string_2_report_blocks(
+    input_code: str,
+    skip_bodies: bool = False,
+    jobs: Union[int, None] = None,
+    executor: Union[Executor, None] = None,
+    config: Union[StubConfig, None] = None,
+) -> StubReport:
+    """
+    cython_string_2_report with the source split into top level blocks (see segment_blocks)
+    that are parsed concurrently in a process pool, the report matches the serial one
+    """
+
+    # resolved here, workers started by spawn do not share the set_* globals (the config has to be picklable)
+    config = config or default_config()
+    prepared_code = prepare_source(input_code, config)
+    blocks = [(start, prepared_code[start:end]) for start, end in segment_blocks(prepared_code)]
+    job = partial(block_fragments, skip_bodies=skip_bodies, config=config)
+    pooled_job = partial(_pooled_block_fragments, skip_bodies=skip_bodies, config=config)
+
+    chunksize = max(1, len(blocks) // (4 * (jobs or os.cpu_count() or 1)))
+
+    if executor is None and (jobs == 1 or len(blocks) == 1):
+        results = map(job, blocks)
+    elif executor is None:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(_merge_stats(pool.map(pooled_job, blocks, chunksize=chunksize)))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # threads record their packrat statistics in this process already
+        if isinstance(executor, ProcessPoolExecutor):
+            results = _merge_stats(executor.map(pooled_job, blocks, chunksize=chunksize))
+        else:
+            results = executor.map(job, blocks, chunksize=chunksize)
+
+    return block_report(prepared_code, blocks, results)
+
+
+def block_report(
+    prepared_code: str,
+    blocks: List[Tuple[int, str]],
+    results: Iterable[Tuple[List[StubFragment], List[Tuple[int, int, int, str]]]],
+) -> StubReport:
+    """join the fragments of the blocks of prepared_code into the report of the full source"""
+
+    stub_parts = []
+    parsed = []
+    diagnostics = []
+    scan_loc = 0
+    for (block_start, block_code), (fragments, skipped) in zip(blocks, results):
+        diagnostics.extend(diagnostic(prepared_code, *region) for region in skipped)
+
+        block_end = block_start + len(block_code)
+
+        for fragment in fragments:
+            start, end = fragment.start, fragment.end
+
+            if start == block_start and block_start > 0:
+                # the full source scan reaches this block from where the previous block stopped, the match
+                # starts there (LineStart directives at the first line start)
+                start = scan_loc
+                if prepared_code[block_start] == "#" and prepared_code[start - 1] != "\n":
+                    start = prepared_code.find("\n", start) + 1
+
+            if block_end < len(prepared_code):
+                # whitespace is skipped to the end of the block, the next block starts with a token
+                end = min(end, block_end)
+
+            parsed.append((start, end))
+            if fragment.text:
+                stub_parts.append(fragment.text)
+
+        if skipped and (not fragments or skipped[-1][0] > fragments[-1].start):
+            # error recovery skipped the rest of the block, the full source scan resumes at the next block
+            scan_loc = block_end
+        else:
+            # where scanning the full source resumes: end of the last match or the last unparsed line
+            scan_loc = max(parsed[-1][1] if parsed else 0, block_start + len(block_code.rstrip()))
+
+    spans, unparsed_text, coverage = unparsed_regions(prepared_code, parsed)
+    return StubReport("\n".join(stub_parts), spans, unparsed_text, coverage, diagnostics)
+
+
+def _shift(
+    result: Tuple[List[StubFragment], List[Tuple[int, int, int, str]]], offset: int
+) -> Tuple[List[StubFragment], List[Tuple[int, int, int, str]]]:
+    fragments, skipped = result
+    return (
+        [StubFragment(fragment.text, offset + fragment.start, offset + fragment.end) for fragment in fragments],
+        [(offset + start, offset + end, offset + error, reason) for start, end, error, reason in skipped],
+    )
+
+
+class IncrementalStub:
+    """
+    reports of successive versions of one source (e.g. while it is edited), only the top level blocks
+    (see segment_blocks) whose text changed since the previous update are parsed again
+    the report matches cython_string_2_report_blocks of the same source
+    """
+
+    def __init__(self, skip_bodies: bool = False, config: Union[StubConfig, None] = None):
+        self.skip_bodies = skip_bodies
+        # resolved once, cached blocks stay valid only for the config they were parsed with
+        self.config = config or default_config()
+        self.reused = 0
+        self.parsed = 0
+        self._blocks: Dict[bytes, Tuple[List[StubFragment], List[Tuple[int, int, int, str]]]] = {}
+
+    def update(self, input_code: str) -> StubReport:
+        """report of the new version of the source, reused and parsed count the blocks of this update"""
+
+        prepared_code = prepare_source(input_code, self.config)
+        blocks = [(start, prepared_code[start:end]) for start, end in segment_blocks(prepared_code)]
+
+        # blocks are parsed at offset 0 and moved to where they are now
+        current = {}
+        results = []
+        self.reused = self.parsed = 0
+        for block_start, block_code in blocks:
+            key = hashlib.blake2b(block_code.encode(), digest_size=16).digest()
+            result = current.get(key) or self._blocks.get(key)
+            if result is None:
+                result = block_fragments((0, block_code), self.skip_bodies, self.config)
+                self.parsed += 1
+            else:
+                self.reused += 1
+            current[key] = result
+            results.append(_shift(result, block_start))
+
+        # blocks of older versions are dropped
+        self._blocks = current
+        return block_report(prepared_code, blocks, results)
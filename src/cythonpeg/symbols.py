@@ -0,0 +1,135 @@
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Set, Union
+import hashlib
+import os
+from cythonpeg import ir
+from cythonpeg.cache import StubCache
+from cythonpeg.tree2string import StubConfig, cython_string_2_module, type2str
+
+# python type a cython definition is seen as from python code
+PYTHON_TYPES = {"struct": "dict", "enum": "int"}
+
+
+class Symbol(NamedTuple):
+    """top level ctypedef, struct, enum or cdef class, target is the type its name resolves to"""
+
+    name: str
+    kind: str
+    target: str
+    path: str
+
+
+def source_symbols(input_code: str, path: str = "") -> List[Symbol]:
+    """symbols defined at the top level of a .pyx/.pxd source"""
+
+    symbols = []
+    for node in cython_string_2_module(input_code, skip_bodies=True, config=StubConfig()).body:
+        if isinstance(node, ir.Section):
+            for typedef in node.body:
+                if isinstance(typedef, ir.Typedef):
+                    symbols.append(Symbol(typedef.name, "ctypedef", type2str(typedef.type, StubConfig()), path))
+        elif isinstance(node, ir.Struct):
+            symbols.append(Symbol(node.name, "struct", PYTHON_TYPES["struct"], path))
+        elif isinstance(node, ir.Enum) and node.cython:
+            symbols.append(Symbol(node.name, "enum", PYTHON_TYPES["enum"], path))
+        elif isinstance(node, ir.ClassDef) and node.cython:
+            symbols.append(Symbol(node.name, "cclass", node.name, path))
+
+    return symbols
+
+
+def file_symbols(path: Union[Path, str]) -> List[Symbol]:
+    with open(path, "r") as file:
+        return source_symbols(file.read(), str(path))
+
+
+class SymbolIndex:
+    """
+    name -> symbol over all files of a project, the first definition of a name wins
+    resolve follows ctypedef chains to the type a name stands for, names defined in the
+    excluded file (the file being stubbed, see for_file) are left as they are
+    """
+
+    def __init__(self, symbols: Iterable[Symbol] = (), exclude: str = ""):
+        self.symbols: Dict[str, Symbol] = {}
+        self.defined: Dict[str, Set[str]] = {}
+        for symbol in symbols:
+            self.symbols.setdefault(symbol.name, symbol)
+            self.defined.setdefault(symbol.path, set()).add(symbol.name)
+
+        self.exclude = exclude
+        self._local = self.defined.get(exclude, set())
+        self._digest = hashlib.sha256(repr(sorted(self.symbols.values())).encode()).hexdigest()
+
+    def for_file(self, path: Union[Path, str]) -> "SymbolIndex":
+        """view of the index that leaves the names defined in path to its own stub"""
+
+        view = SymbolIndex.__new__(SymbolIndex)
+        view.symbols, view.defined, view._digest = self.symbols, self.defined, self._digest
+        view.exclude = str(Path(path).resolve())
+        view._local = self.defined.get(view.exclude, set())
+        return view
+
+    def resolve(self, name: str) -> str:
+        # bounded, ctypedef cycles are invalid cython but must not hang
+        for _ in range(16):
+            symbol = self.symbols.get(name)
+            if symbol is None or name in self._local or symbol.target == name:
+                break
+            name = symbol.target
+        return name
+
+    def fingerprint(self) -> str:
+        return f"{self._digest}:{self.exclude}"
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+
+def project_sources(root: Union[Path, str]) -> List[Path]:
+    """.pyx and .pxd files below root"""
+    root = Path(root)
+    return sorted(path for pattern in ("*.pyx", "*.pxd") for path in root.rglob(pattern) if path.is_file())
+
+
+def build_symbol_index(
+    paths: Iterable[Union[Path, str]], jobs: int = 1, cache: Union[StubCache, None] = None
+) -> SymbolIndex:
+    """
+    index of the symbols defined in paths, files are indexed by jobs worker processes
+    cache: reuse the symbols of unchanged files from the stub cache
+    """
+
+    # symbols are located by absolute path, see SymbolIndex.for_file
+    paths = [Path(path).resolve() for path in paths]
+    symbols: Dict[Path, List[Symbol]] = {}
+    keys = {}
+
+    if cache is not None:
+        for path in paths:
+            with open(path, "r") as file:
+                keys[path] = cache.key(file.read(), StubConfig(), symbols=True, path=str(path))
+            entry = cache.get_entry(keys[path])
+            if entry is not None:
+                symbols[path] = [Symbol(*symbol) for symbol in entry["symbols"]]
+
+    missing = [path for path in paths if path not in symbols]
+    if jobs > 1 and len(missing) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunksize = max(1, len(missing) // (4 * jobs))
+            symbols.update(zip(missing, executor.map(file_symbols, missing, chunksize=chunksize)))
+    else:
+        symbols.update((path, file_symbols(path)) for path in missing)
+
+    if cache is not None:
+        for path in missing:
+            cache.set_entry(keys[path], {"symbols": symbols[path]})
+
+    return SymbolIndex(symbol for path in paths for symbol in symbols[path])
+
+
+def project_root(paths: Iterable[Union[Path, str]]) -> Path:
+    """deepest directory containing all paths"""
+    return Path(os.path.commonpath([str(Path(path).resolve().parent) for path in paths]))
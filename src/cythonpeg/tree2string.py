@@ -1,8 +1,12 @@
-from pyparsing import ParseResults
-from typing import Union, Tuple, IO
-import textwrap
-from cythonpeg.definitions import cython_parser
+from __future__ import annotations
+from typing import Union, Tuple, IO, List, Iterable, Iterator, NamedTuple, TYPE_CHECKING
+import io
+import os
 from typing import Callable
+from cythonpeg import ir
+
+if TYPE_CHECKING:
+    from cythonpeg.symbols import SymbolIndex
 
 
 def partial_cython_2_python(type_str: str) -> str:
@@ -33,385 +37,553 @@ def set_indent(indent: str):
     INDENT = indent
 
 
-def expression2str(expression: Union[ParseResults, str]):
-    """EXPRESSION parsed tree to string"""
-
-    if isinstance(expression, ParseResults):
-        expression_string = ""
+SYMBOLS = None
 
-        if expression.getName() == "list":
-            expression_string += "[" + ", ".join(expression2str(e) for e in expression) + "]"
 
-        elif expression.getName() == "set":
-            expression_string += "{" + ", ".join(expression2str(e) for e in expression) + "}"
+def set_symbol_index(symbols: Union[SymbolIndex, None]):
+    """project symbols used to resolve types defined in other files (None disables resolution)"""
+    global SYMBOLS
+    SYMBOLS = symbols
 
-        elif expression.getName() == "tuple":
-            expression_string += "(" + ", ".join(expression2str(e) for e in expression) + ")"
 
-        elif expression.getName() == "dict":
-            expression_string += (
-                "{" + ", ".join(f"{expression2str(k)} : {expression2str(v)}" for k, v in expression) + "}"
-            )
-        else:
-            for e in expression:
-                expression_string += expression2str(e)
+ENGINES = ("pyparsing", "cython")
+ENGINE = "pyparsing"
 
-        return expression_string
 
-    elif isinstance(expression, str):
-        return expression
+def set_engine(engine: str):
+    """parser building the IR: "pyparsing" (the cython_parser grammar) or "cython" (Cython.Compiler)"""
+    global ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"unknown engine {engine!r}, expected one of {', '.join(ENGINES)}")
+    ENGINE = engine
 
 
-def type2str(type_tree: ParseResults):
-    """type_definition parsed tree to string"""
+RECOVER = False
+RAW_DEFAULTS = False
+EXTERN_DECLARATIONS = False
 
-    def _type2_str(type_tree: ParseResults):
-        type_name, type_bracket, type_default = type_tree
-
-        if type_bracket:
-            bracket_str = "[" + ", ".join(_type2_str(arg) for arg in type_bracket) + "]" if type_bracket else ""
-        else:
-            bracket_str = ""
 
-        type_default_str = f"={expression2str(type_default)}" if type_default else ""
+def set_error_recovery(recover: bool):
+    """skip a definition that fails to parse to the next line that can start one, see dispatch_scan"""
+    global RECOVER
+    RECOVER = recover
 
-        return f"{partial_cython_2_python(type_name)}{bracket_str}{type_default_str}"
 
-    return complete_cython_2_python(_type2_str(type_tree))
+def set_raw_defaults(raw_defaults: bool):
+    """emit default values as written in the source instead of parsing them, see RawDefault"""
+    global RAW_DEFAULTS
+    RAW_DEFAULTS = raw_defaults
 
 
-def arg2str(arg: ParseResults):
-    """python_argument_definition parsed tree to string"""
+def set_extern_declarations(extern_declarations: bool):
+    """emit the structs and enums declared in cdef extern from blocks, see extern_declarations"""
+    global EXTERN_DECLARATIONS
+    EXTERN_DECLARATIONS = extern_declarations
 
-    arg_name, arg_type, arg_default = arg
 
-    if isinstance(arg_type, ParseResults):
-        type_str = type2str(arg_type)
-    else:
-        type_str = ""
+class StubConfig(NamedTuple):
+    """
+    per call stub configuration passed to every emitter, immutable so it can be shared between threads
+    the set_* functions change the defaults used when no config is given
+    """
 
-    type_str = f": {type_str}" if type_str else ""
-    arg_default_str = f"={expression2str(arg_default)}" if arg_default else ""
+    type_converter_partial: Callable[[str], str] = partial_cython_2_python
+    type_converter_complete: Callable[[str], str] = complete_cython_2_python
+    indent: str = INDENT
+    symbols: Union[SymbolIndex, None] = None
+    engine: str = "pyparsing"
+    recover: bool = False
+    raw_defaults: bool = False
+    extern_declarations: bool = False
 
-    return f"{arg_name}{type_str}{arg_default_str}"
 
+def default_config() -> StubConfig:
+    """configuration from the current set_* defaults"""
+    return StubConfig(
+        partial_cython_2_python,
+        complete_cython_2_python,
+        INDENT,
+        SYMBOLS,
+        ENGINE,
+        RECOVER,
+        RAW_DEFAULTS,
+        EXTERN_DECLARATIONS,
+    )
 
-def args2str(args: ParseResults, newlines: bool = False):
-    """python_arguments_definition parsed tree to string"""
 
-    def format_arg(arg):
-        if arg[0] == "self":
-            return "self"  # handle unique case cdef inside class
-        if arg.getName() == "python_argument":
-            return arg2str(arg)
-        elif arg.getName() == "cython_argument":
-            return cythonarg2str(arg)
+def type2str(type_node: ir.Type, config: StubConfig):
+    """Type to string"""
 
-    joiner = f",\n{INDENT}" if newlines else ", "
-    return joiner.join(format_arg(arg) for arg in args)
+    def _type2_str(type_node: ir.Type):
+        bracket_str = "[" + ", ".join(_type2_str(arg) for arg in type_node.args) + "]" if type_node.args else ""
+        type_default_str = f"={type_node.default}" if type_node.default else ""
+        name = type_node.name if config.symbols is None else config.symbols.resolve(type_node.name)
+        return f"{config.type_converter_partial(name)}{bracket_str}{type_default_str}"
 
+    return config.type_converter_complete(_type2_str(type_node))
 
-def def2str(result: ParseResults):
-    """function_definition parsed tree to string"""
 
-    decleration, docs, body = result
-    name, args, ret = decleration
+def arg2str(arg: ir.Arg, config: StubConfig):
+    """Arg to string"""
 
-    return_str = type2str(ret) if ret else ""
-    return_str = f" -> {return_str}" if return_str else ""
-    doc_str = f'\n{INDENT}"""{docs}"""' if docs else ""
+    if arg.cython:
+        default_str = f" = {arg.default}" if arg.default else ""
+        return f"{arg.name}: {type2str(arg.type, config)}{default_str}"
 
-    arg_str = args2str(args)
-    if len(arg_str) > 100:
-        arg_str = args2str(args, newlines=True)
+    type_str = type2str(arg.type, config) if arg.type is not None else ""
+    type_str = f": {type_str}" if type_str else ""
+    arg_default_str = f"={arg.default}" if arg.default else ""
 
-    return f"def {name}({arg_str}){return_str}:{doc_str}\n{INDENT}...\n"
+    return f"{arg.name}{type_str}{arg_default_str}"
 
 
-def cythonarg2str(arg: ParseResults):
-    t, n, d = arg
-    type_str = type2str(t)
-    default_str = f" = {expression2str(d)}" if d else ""
-    return f"{n}: {type_str}{default_str}"
+class StubWriter:
+    """
+    single output buffer, every emitter writes its lines once at the current depth
+    text is written in whole lines, non blank lines are prefixed with depth indents
+    (the result of textwrap.indent at every nesting level, without re-copying the nested text)
+    """
 
+    __slots__ = ("config", "depth", "parts")
 
-def cythonargs2str(args: ParseResults, newlines: bool = False):
-    """cython_arguments_definition parsed tree to string"""
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.depth = 0
+        self.parts = []
 
-    def format_arg(arg):
-        if arg[0] == "self":
-            return "self"  # handle unique case cdef inside class
-        if arg.getName() == "python_argument":
-            return arg2str(arg)
-        elif arg.getName() == "cython_argument":
-            return cythonarg2str(arg)
+    def write(self, text: str):
+        if not self.depth:
+            self.parts.append(text)
+            return
 
-    joiner = f",\n{INDENT}" if newlines else ", "
-    return joiner.join([format_arg(arg) for arg in args])
+        prefix = self.config.indent * self.depth
+        self.parts.append("".join(prefix + line if line.strip() else line for line in text.splitlines(True)))
 
+    def getvalue(self) -> str:
+        return "".join(self.parts)
 
-def cdef2str(result: ParseResults):
-    """cython_function_definition parsed tree to string"""
 
-    decleration, docs, body = result
-    ret, name, args, gil = decleration
+def def2str(function: ir.FunctionDef, writer: StubWriter):
+    """FunctionDef to string"""
 
-    doc_str = f'\n{INDENT}"""{docs}"""' if docs else ""
-    ret_str = type2str(ret) if ret else ""
-    ret_str = f" -> {ret_str}" if ret_str else ""
+    config = writer.config
+    return_str = type2str(function.returns, config) if function.returns is not None else ""
+    return_str = f" -> {return_str}" if return_str else ""
+    doc_str = f'\n{config.indent}"""{function.doc}"""' if function.doc else ""
 
-    arg_str = cythonargs2str(args)
+    # arguments are rendered once, wrapped one per line when the line gets long
+    args = [arg2str(arg, config) for arg in function.args]
+    arg_str = ", ".join(args)
     if len(arg_str) > 100:
-        arg_str = cythonargs2str(args, newlines=True)
+        arg_str = f",\n{config.indent}".join(args)
 
-    return f"def {name}({arg_str}){ret_str}:{doc_str}\n{INDENT}..." + "\n"
+    writer.write(f"def {function.name}({arg_str}){return_str}:{doc_str}\n{config.indent}...\n")
 
 
-def enum2str(result: ParseResults):
-    """python_class_definition parsed tree to string (enum)"""
+def enum2str(enum: ir.Enum, writer: StubWriter):
+    """Enum to string"""
 
-    decleration, docs, body = result
-    name, parent = decleration
+    indent = writer.config.indent
 
-    doc_str = f'\n{INDENT}"""{docs}"""' if docs else ""
-    class_str = f"class {name}{f'({parent})' if parent else ''}:{doc_str}" + "\n"
+    if enum.cython:
+        members = f"\n{indent}".join(f"{member}: int" for member in enum.members)
+        writer.write(f"class {enum.name}({enum.parent}):\n{indent}{members}\n")
+        return
 
-    for b in body:
-        class_str += INDENT + b + "\n"
+    doc_str = f'\n{indent}"""{enum.doc}"""' if enum.doc else ""
+    class_str = f"class {enum.name}{f'({enum.parent})' if enum.parent else ''}:{doc_str}\n"
+    writer.write(class_str + "".join(f"{indent}{member}\n" for member in enum.members))
 
-    return class_str
 
+def class2str(class_node: ir.ClassDef, writer: StubWriter):
+    """ClassDef to string"""
 
-def class2str(result: ParseResults):
-    """python_class_definition parsed tree to string (enum)"""
+    indent = writer.config.indent
+    doc_str = f'\n{indent}"""{class_node.doc}"""' if class_node.doc else ""
+    writer.write(f"class {class_node.name}{f'({class_node.parent})' if class_node.parent else ''}:{doc_str}\n\n")
 
-    decleration, docs, body = result
-    name, parent = decleration
+    writer.depth += 1
+    if not class_node.body:
+        writer.write("...\n")
 
-    if parent == "Enum":
-        return enum2str(result)
+    for i, member in enumerate(class_node.body):
+        if i:
+            writer.write("\n")
+        string_constructor[type(member)](member, writer)
+    writer.depth -= 1
 
-    doc_str = f'\n{INDENT}"""{docs}"""' if docs else ""
-    class_str = f"class {name}{f'({parent})' if parent else ''}:{doc_str}\n\n"
 
-    element_string = []
-    for i, b in enumerate(body):
-        if not isinstance(b, ParseResults):
-            continue
+def struct2str(struct: ir.Struct, writer: StubWriter):
+    """Struct to string"""
 
-        parser_name = b.getName()
-        if parser_name == "class_decleration":
-            result = (b, body[i + 1], body[i + 2])
-            element_string.append(textwrap.indent(class2str(result), INDENT))
+    config = writer.config
+    doc_str = f'\n{config.indent}"""{struct.doc}"""' if struct.doc else ""
+    fields = "\n".join(f"{config.indent}{name}: {type2str(type_node, config)}" for name, type_node in struct.fields)
+    writer.write(f"class {struct.name}:{doc_str}\n{fields or config.indent + '...'}\n")
 
-        elif parser_name == "def_decleration":
-            result = (b, body[i + 1], body[i + 2])
-            element_string.append(textwrap.indent(def2str(result), INDENT))
-
-        elif parser_name == "cdef_decleration":
-            result = (b, body[i + 1], body[i + 2])
-            element_string.append(textwrap.indent(cdef2str(result), INDENT))
-
-    if not len(element_string):
-        class_str += f"{INDENT}...\n"
-    else:
-        class_str += "\n".join(element_string)
-
-    return class_str
 
+def name_alias_2_str(name, alias):
+    alias_str = f" as {alias}" if alias else ""
+    return f"{name}{alias_str}"
 
-def cenum2str(result: ParseResults):
-    """enum_definition parsed tree to string"""
-    name, body = result
-    str = ""
-    str += f"class {name[0]}(Enum):\n{INDENT}"
-    result.pop(0)
-    return str + f"\n{INDENT}".join([f"{imp[0]}: int" for imp in body]) + "\n"
 
+def import2str(imp: ir.Import, writer: StubWriter, newlines=True):
+    """Import to string"""
 
-def struct2str(result):
-    """cython_struct_definition parsed tree to string"""
+    names = [name_alias_2_str(n, a) for n, a in imp.names]
 
-    decleration, docs, body = result
-    parent = ""
+    if not imp.module:
+        writer.write(f"import {', '.join(names)}\n")
+    elif newlines and len(names) > 2:
+        writer.write(f"from {imp.module} import (\n" + ",\n".join(f"\t{name}" for name in names) + "\n)\n")
+    else:
+        writer.write(f"from {imp.module} import {', '.join(names)}\n")
 
-    class_str = ""
-    doc_str = f'\n{INDENT}"""{docs}"""' if docs else ""
-    class_str += f"class {decleration[0]}{f'({parent})' if parent else ''}:{doc_str}\n"
 
-    element_string = []
-    for b in body:
-        type_str, names = b
+def ctypedef2str(typedef: ir.Typedef, writer: StubWriter):
+    """Typedef to string"""
 
-        for name in names:
-            element_string.append(f"{INDENT}{name}: {type2str(type_str)}")
+    writer.write(f"{typedef.name} = {typedef.type.name}\n")
 
-    return class_str + "\n".join(element_string) + "\n"
 
+def section2str(section: ir.Section, writer: StubWriter):
+    """Section (imports, ctypedefs) to string, one line per node"""
 
-def cclass2str(result: ParseResults):
-    """cython_class_definition parsed tree to string"""
+    for node in section.body:
+        string_constructor[type(node)](node, writer)
 
-    decleration, docs, body = result
-    name, parent = decleration
+    if not section.body:
+        writer.write("\n")
 
-    class_str = ""
-    doc_str = f'\n{INDENT}"""{docs}"""' if docs else ""
-    class_str += f"class {name}{f'({parent})' if parent else ''}:{doc_str}\n\n"
 
-    element_string = []
-    for i, b in enumerate(body):
-        if not isinstance(b, ParseResults):
-            continue
+def dataclass2str(dataclass: ir.Dataclass, writer: StubWriter):
+    """Dataclass to string"""
 
-        parser_name = b.getName()
-        if parser_name == "cclass_decleration":
-            result = (b, body[i + 1], body[i + 2])
-            element_string.append(textwrap.indent(cclass2str(result), INDENT))
+    writer.write(f'@dataclass\nclass {dataclass.name}:\n{writer.config.indent}"""{dataclass.doc}"""\n')
 
-        elif parser_name == "def_decleration":
-            result = (b, body[i + 1], body[i + 2])
-            element_string.append(textwrap.indent(def2str(result), INDENT))
+    writer.depth += 1
+    recursive_body(dataclass.body, writer)
+    writer.depth -= 1
 
-        elif parser_name == "cdef_decleration":
-            result = (b, body[i + 1], body[i + 2])
-            element_string.append(textwrap.indent(cdef2str(result), INDENT))
 
-    if not len(element_string):
-        class_str += f"{INDENT}...\n"
-    else:
-        class_str += "\n".join(element_string)
+def extern2str(extern: ir.Extern, writer: StubWriter):
+    """Extern to string, the declared structs and enums as top level classes"""
 
-    return class_str
+    for i, node in enumerate(extern.body):
+        if i:
+            writer.write("\n")
+        string_constructor[type(node)](node, writer)
 
 
-def name_alias_2_str(name, alias):
-    alias_str = f" as {alias}" if alias else ""
-    return f"{name}{alias_str}"
+def unimplimented2str(node: ir.Opaque, writer: StubWriter):
+    pass
 
 
-def import2str(result: ParseResults, newlines=True):
-    """import2str_definition parsed tree to string"""
+def recursive_body(body: list, writer: StubWriter):
+    """nested source lines to string, indented blocks are followed by a blank line"""
 
-    import_str = ""
-    if len(result) == 1:
-        import_str += f"import {', '.join(name_alias_2_str(n, a) for n, a in result[0])}"
+    for b in body:
+        if isinstance(b, str):
+            writer.write(b + "\n")
+        else:
+            writer.depth += 1
+            recursive_body(b, writer)
+            writer.depth -= 1
+            writer.write("\n")
 
-    elif len(result) == 2:
-        if newlines and len(result[1]) > 2:
-            # import_str += f"from {result[0]} import (\n"
-            # for i, r in enumerate(result[1]):
-            #     import_str += f"{INDENT}{r}"
-            #     import_str += "\n" if len(result[1]) == i+1 else ",\n"
-            # import_str += ')'
+    if not body:
+        writer.write("\n")
 
-            nl = "\n"
-            tab = "\t"
-            import_str += f"from {result[0]} import ({nl}{f',{nl}'.join(f'{tab}{name_alias_2_str(n, a)}' for n, a in result[1])}{nl})"
-        else:
-            import_str += f"from {result[0]} import {', '.join(name_alias_2_str(n, a) for n, a in result[1])}"
 
-    return import_str
+def node2str(node: ir.Node, config: StubConfig) -> str:
+    """stub text of one top level node"""
 
+    writer = StubWriter(config)
+    string_constructor[type(node)](node, writer)
+    return writer.getvalue()
 
-def import_section2str(result: ParseResults):
-    """import_section2str_definition parsed tree to string"""
-    return "\n".join([import2str(imp) for imp in result]) + "\n"
 
+def module2str(module: ir.Module, config: Union[StubConfig, None] = None) -> str:
+    """Module to stub, the fragments of its top level nodes separated by blank lines"""
 
-def dataclass2str(result: ParseResults):
-    name, docs, body = result
-    dataclass_str = ""
-    dataclass_str += "@dataclass" + "\n"
-    dataclass_str += f"class {name}:" + "\n"
-    dataclass_str += f'{INDENT}"""{docs}"""\n'
-    dataclass_str += textwrap.indent(recursive_body(body), INDENT)
-    return dataclass_str
+    config = config or default_config()
+    texts = (node2str(node, config) for node in module.body)
+    return "\n".join(text for text in texts if text)
 
 
-def unimplimented2str(result: ParseResults):
-    return ""
+# 3.8+ compatible switch
+string_constructor = {
+    ir.FunctionDef: def2str,
+    ir.ClassDef: class2str,
+    ir.Enum: enum2str,
+    ir.Struct: struct2str,
+    ir.Dataclass: dataclass2str,
+    ir.Import: import2str,
+    ir.Typedef: ctypedef2str,
+    ir.Section: section2str,
+    ir.Extern: extern2str,
+    ir.Opaque: unimplimented2str,
+}
 
 
-def recursive_body(body: ParseResults):
-    """IndentedBlock(restOfLine) parsed tree to string"""
-    element_string = []
-    for b in body:
-        if isinstance(b, ParseResults):
-            element_string.append(textwrap.indent(recursive_body(b), INDENT))
+class UnparsedSpan(NamedTuple):
+    """unparsed source region, offsets and columns refer to the tab expanded source"""
 
-        elif isinstance(b, str):
-            element_string.append(b)
+    start: int
+    end: int
+    line: int
+    column: int
+    end_line: int
+    end_column: int
+    text: str
 
-    return "\n".join(element_string) + "\n"
 
+class Diagnostic(NamedTuple):
+    """region skipped by error recovery and why the definition at its start failed, see UnparsedSpan"""
 
-def ctypedef2str(result: ParseResults):
-    """ctypedef parsed tree to string"""
+    start: int
+    end: int
+    line: int
+    column: int
+    end_line: int
+    end_column: int
+    reason: str
 
-    t, n = result
-    return n + " = " + t[0]
 
+class StubReport(NamedTuple):
+    stub: str
+    unparsed: List[UnparsedSpan]
+    unparsed_text: str
+    coverage: float
+    diagnostics: List[Diagnostic]
 
-def ctypedef_section2str(result: ParseResults):
-    """ctypedef section parsed tree to string"""
 
-    return "\n".join([ctypedef2str(imp) for imp in result]) + "\n"
+def merge_spans(spans: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """sorted union of (start, end) intervals"""
 
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def unparsed_regions(input_code: str, parsed: Iterable[Tuple[int, int]]) -> Tuple[List[UnparsedSpan], str, float]:
+    """
+    complement of the parsed intervals
+    returns the unparsed spans (trimmed of whitespace), the unparsed text and the
+    percentage of non whitespace characters that were parsed
+    """
+
+    gaps = []
+    loc = 0
+    for start, end in merge_spans(parsed):
+        if start > loc:
+            gaps.append((loc, start))
+        loc = max(loc, end)
+    if loc < len(input_code):
+        gaps.append((loc, len(input_code)))
+
+    spans = []
+    line, line_loc = 1, 0
+    unparsed_characters = 0
+    for gap_start, gap_end in gaps:
+        text = input_code[gap_start:gap_end]
+        stripped = text.strip()
+        if not stripped:
+            continue
 
-def cython_string_2_stub(input_code: str) -> Tuple[str, str]:
-    """tree traversal and translation of ParseResults to string representation"""
+        start = gap_start + len(text) - len(text.lstrip())
+        end = start + len(stripped)
+        unparsed_characters += len("".join(stripped.split()))
 
-    # replace tabs with spaces
-    input_code = input_code.replace("\t", INDENT)
+        line += input_code.count("\n", line_loc, start)
+        line_loc = start
+        end_line = line + stripped.count("\n")
 
-    # indentblock needs newline as sentinal
-    input_code += "\n"
+        column = start - input_code.rfind("\n", 0, start)
+        end_column = end - input_code.rfind("\n", 0, end)
+        spans.append(UnparsedSpan(start, end, line, column, end_line, end_column, stripped))
 
-    # PEG top down scan generator
-    tree = cython_parser.scan_string(input_code)
+    total_characters = len("".join(input_code.split()))
+    coverage = 100 * (1 - unparsed_characters / total_characters) if total_characters else 100.0
+    unparsed_text = "".join(input_code[s:e] for s, e in gaps).strip()
 
-    # 3.8+ compatible switch
-    string_constructor = {
-        "def": def2str,
-        "cdef": cdef2str,
-        "class": class2str,
-        "cenum": cenum2str,
-        "cclass": cclass2str,
-        "cstruct": struct2str,
-        "dataclass": dataclass2str,
-        "import_section": import_section2str,
-        "ctypedef_section": ctypedef_section2str,
-    }
+    return spans, unparsed_text, coverage
 
-    # ParseResults -> Python Stub Element
-    def parse_branch(branch: Tuple[ParseResults, int, int]):
-        result, start, end = branch
-        return string_constructor.get(result.get_name(), unimplimented2str)(result), start, end
 
-    parsed_tree = [parse_branch(b) for b in tree]
+def diagnostic(input_code: str, start: int, end: int, error: int, reason: str) -> Diagnostic:
+    """Diagnostic of a region skipped by dispatch_scan, the reason is completed with the error location"""
 
-    if len(parsed_tree) == 0:
-        return "", input_code
+    line = input_code.count("\n", 0, start) + 1
+    end_line = line + input_code.count("\n", start, end)
+    column = start - input_code.rfind("\n", 0, start)
+    end_column = end - input_code.rfind("\n", 0, end)
 
-    tree_str, start, end = zip(*parsed_tree)
+    error_line = line + input_code.count("\n", start, error)
+    error_column = error - input_code.rfind("\n", 0, error)
+    reason = f"{reason} at line {error_line}, column {error_column}"
+    return Diagnostic(start, end, line, column, end_line, end_column, reason)
 
-    # TODO: this code is ugly
-    mutable_string = list(input_code + " ")
 
-    for s, e in zip(start, end):
-        for i in range(s, e):
-            mutable_string[i] = ""
+class StubFragment(NamedTuple):
+    """stub text of one top level definition, start/end index the prepared (tab expanded) source"""
 
-    tree_str = [s for s in tree_str if s]
-    stub_file = ""
-    stub_file += "\n".join(tree_str)
-    unparsed_lines = "".join(mutable_string).strip()
+    text: str
+    start: int
+    end: int
 
-    return stub_file, unparsed_lines
 
+def prepare_source(input_code: str, config: Union[StubConfig, None] = None) -> str:
+    # replace tabs with spaces
+    input_code = input_code.replace("\t", (config or default_config()).indent)
 
-def cython_file_2_stub(file: IO[str]) -> Tuple[str, str]:
+    # indentblock needs newline as sentinal
+    return input_code + "\n"
+
+
+def _stub_fragments(
+    prepared_code: str,
+    skip_bodies: bool = False,
+    config: Union[StubConfig, None] = None,
+    diagnostics: Union[List[Tuple[int, int, int, str]], None] = None,
+) -> Iterator[StubFragment]:
+    config = config or default_config()
+
+    # IR -> Python Stub Element
+    for node, start, end in _ir_nodes(prepared_code, skip_bodies, config, diagnostics):
+        yield StubFragment(node2str(node, config), start, end)
+
+
+def _ir_nodes(
+    prepared_code: str,
+    skip_bodies: bool = False,
+    config: Union[StubConfig, None] = None,
+    diagnostics: Union[List[Tuple[int, int, int, str]], None] = None,
+) -> Iterator[Tuple[ir.Node, int, int]]:
+    config = config or default_config()
+    if config.engine == "cython":
+        from cythonpeg.cython_engine import CythonSyntaxError, ir_nodes
+
+        # Cython rejects the whole file on a syntax error, the grammar reports what it cannot parse instead
+        try:
+            nodes = list(ir_nodes(prepared_code, skip_bodies, config.extern_declarations))
+        except CythonSyntaxError:
+            nodes = None
+        if nodes is not None:
+            yield from nodes
+            return
+
+    # grammar is built on first use
+    from cythonpeg.definitions import dispatch_scan
+    from cythonpeg.utilities import memoization_enabled, record_memoization_stats
+
+    # PEG top down scan generator, dispatched on the leading keyword of each line
+    scan = dispatch_scan(prepared_code, skip_bodies, config.recover, diagnostics, config.raw_defaults)
+    for result, start, end in scan:
+        # ParseResults -> IR
+        node = ir.build(result)
+        if config.extern_declarations and isinstance(node, ir.Extern):
+            from cythonpeg.extern import extern_declarations
+
+            node.body = extern_declarations(prepared_code[start:end].lstrip())
+        yield node, start, end
+
+    if memoization_enabled():
+        record_memoization_stats()
+
+
+def cython_string_2_module(
+    input_code: str, skip_bodies: bool = False, config: Union[StubConfig, None] = None
+) -> ir.Module:
+    """
+    IR of the top level definitions, spans index the prepared (tab expanded) source
+    the module pickles and can be emitted with different configs (module2str)
+    """
+
+    config = config or default_config()
+    module = ir.Module()
+    for node, start, end in _ir_nodes(prepare_source(input_code, config), skip_bodies, config):
+        module.body.append(node)
+        module.spans.append((start, end))
+    return module
+
+
+def iter_stub_fragments(
+    input_code: str, skip_bodies: bool = False, config: Union[StubConfig, None] = None
+) -> Iterator[StubFragment]:
+    """
+    yields the stub fragment of each top level definition as soon as it is parsed
+    definitions without a stub representation (directives, extern blocks) yield an empty text
+    """
+    config = config or default_config()
+    return _stub_fragments(prepare_source(input_code, config), skip_bodies, config)
+
+
+def write_stub(
+    input_code: str,
+    file: IO[str],
+    skip_bodies: bool = False,
+    config: Union[StubConfig, None] = None,
+    diagnostics: Union[List[Diagnostic], None] = None,
+) -> Tuple[List[UnparsedSpan], str, float]:
+    """
+    write the stub to file fragment by fragment as it is parsed
+    returns the unparsed spans, unparsed text and parsed coverage (see unparsed_regions)
+    diagnostics: regions skipped by error recovery (config.recover) are appended to it
+    """
+
+    config = config or default_config()
+    prepared_code = prepare_source(input_code, config)
+
+    parsed = []
+    skipped = []
+    separator = ""
+    for fragment in _stub_fragments(prepared_code, skip_bodies, config, skipped):
+        parsed.append((fragment.start, fragment.end))
+
+        if fragment.text:
+            file.write(separator)
+            file.write(fragment.text)
+            separator = "\n"
+
+    if diagnostics is not None:
+        diagnostics.extend(diagnostic(prepared_code, *region) for region in skipped)
+    return unparsed_regions(prepared_code, parsed)
+
+
+def cython_string_2_report(
+    input_code: str, skip_bodies: bool = False, config: Union[StubConfig, None] = None
+) -> StubReport:
+    """
+    parse, build the IR of each top level definition and translate it to its stub representation
+    skip_bodies: find function bodies by indentation only, they are not part of the stub
+    config: type converters and indent of this call, defaults to the set_* values
+    """
+
+    stub_file = io.StringIO()
+    diagnostics = []
+    spans, unparsed_text, coverage = write_stub(input_code, stub_file, skip_bodies, config, diagnostics)
+    return StubReport(stub_file.getvalue(), spans, unparsed_text, coverage, diagnostics)
+
+
+def cython_string_2_stub(
+    input_code: str, skip_bodies: bool = False, config: Union[StubConfig, None] = None
+) -> Tuple[str, str]:
+    """stub and unparsed text, see cython_string_2_report for structured unparsed spans"""
+
+    report = cython_string_2_report(input_code, skip_bodies, config)
+    return report.stub, report.unparsed_text
+
+
+def cython_file_2_stub(
+    file: Union[str, os.PathLike], skip_bodies: bool = False, config: Union[StubConfig, None] = None
+) -> Tuple[str, str]:
+    """cython_string_2_stub of the source at path file"""
     with open(file, mode="r") as f:
         input_code = f.read()
-    return cython_string_2_stub(input_code)
+    return cython_string_2_stub(input_code, skip_bodies, config)
@@ -0,0 +1,172 @@
+from functools import lru_cache
+from typing import Callable, Dict, Union
+import json
+import re
+from cythonpeg.tree2string import StubConfig, INDENT
+
+# bracket containing a slice: float[:, :], double[::1]
+MEMORYVIEW = re.compile(r"\[[^\]]*:")
+
+
+class TypeMap:
+    """
+    declarative type conversion, usable as the partial/complete type converters
+    exact: type name -> python type
+    prefixes: type name prefix -> python type, the longest matching prefix wins
+    memoryview: python type of complete types that are memoryviews (None keeps them)
+    fallback_partial/fallback_complete: called for types the tables do not map
+    results are memoized in bounded caches (cache_size entries per converter)
+    """
+
+    def __init__(
+        self,
+        exact: Union[Dict[str, str], None] = None,
+        prefixes: Union[Dict[str, str], None] = None,
+        memoryview: Union[str, None] = None,
+        fallback_partial: Union[Callable[[str], str], None] = None,
+        fallback_complete: Union[Callable[[str], str], None] = None,
+        cache_size: Union[int, None] = 4096,
+    ):
+        self.exact = dict(exact or {})
+        self.prefixes = dict(prefixes or {})
+        self.memoryview = memoryview
+        self.fallback_partial = fallback_partial
+        self.fallback_complete = fallback_complete
+        self.cache_size = cache_size
+        self._compile()
+
+    def _compile(self):
+        # longest prefix first, the first match is the most specific
+        self._prefixes = sorted(self.prefixes.items(), key=lambda item: len(item[0]), reverse=True)
+        # the memos are attributes, partial and complete stay plain methods that pickle with the TypeMap
+        self._partial_memo = lru_cache(maxsize=self.cache_size)(self._partial)
+        self._complete_memo = lru_cache(maxsize=self.cache_size)(self._complete)
+
+    def partial(self, type_str: str) -> str:
+        """partial type converter (memoized)"""
+        return self._partial_memo(type_str)
+
+    def complete(self, type_str: str) -> str:
+        """complete type converter (memoized)"""
+        return self._complete_memo(type_str)
+
+    def _partial(self, type_str: str) -> str:
+        """partial type component"""
+
+        python_type = self.exact.get(type_str)
+        if python_type is not None:
+            return python_type
+
+        for prefix, python_type in self._prefixes:
+            if type_str.startswith(prefix):
+                return python_type
+
+        return self.fallback_partial(type_str) if self.fallback_partial is not None else type_str
+
+    def _complete(self, type_str: str) -> str:
+        """complete type component"""
+
+        if self.memoryview is not None and MEMORYVIEW.search(type_str):
+            return self.memoryview
+
+        return self.fallback_complete(type_str) if self.fallback_complete is not None else type_str
+
+    def config(self, indent: Union[str, None] = None) -> StubConfig:
+        return StubConfig(self.partial, self.complete, INDENT if indent is None else indent)
+
+    def stats(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """memoization hits, misses, size and hit rate (percent) of both converters"""
+
+        stats = {}
+        for name, converter in (("partial", self._partial_memo), ("complete", self._complete_memo)):
+            info = converter.cache_info()
+            lookups = info.hits + info.misses
+            stats[name] = {
+                "hits": info.hits,
+                "misses": info.misses,
+                "size": info.currsize,
+                "hit_rate": 100 * info.hits / lookups if lookups else 0.0,
+            }
+        return stats
+
+    def clear_cache(self):
+        self._partial_memo.cache_clear()
+        self._complete_memo.cache_clear()
+
+    @classmethod
+    def from_dict(cls, table: Dict, **kwargs) -> "TypeMap":
+        """{"exact": {...}, "prefixes": {...}, "memoryview": "..."}"""
+        return cls(table.get("exact"), table.get("prefixes"), table.get("memoryview"), **kwargs)
+
+    @classmethod
+    def from_json(cls, path: str, **kwargs) -> "TypeMap":
+        with open(path, "r") as file:
+            return cls.from_dict(json.load(file), **kwargs)
+
+    def as_dict(self) -> Dict:
+        return {"exact": self.exact, "prefixes": self.prefixes, "memoryview": self.memoryview}
+
+    def __repr__(self) -> str:
+        # deterministic, the stub cache fingerprints converters bound to a TypeMap by repr
+        fallbacks = [getattr(f, "__qualname__", repr(f)) for f in (self.fallback_partial, self.fallback_complete)]
+        return f"TypeMap({json.dumps(self.as_dict(), sort_keys=True)}, fallbacks={fallbacks})"
+
+    def __getstate__(self) -> Dict:
+        # memoization caches are rebuilt, they do not pickle
+        state = dict(self.__dict__)
+        for key in ("_partial_memo", "_complete_memo", "_prefixes"):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state: Dict):
+        self.__dict__.update(state)
+        self._compile()
+
+
+C_INTEGERS = [
+    "char",
+    "short",
+    "int",
+    "long",
+    "size_t",
+    "ssize_t",
+    "Py_ssize_t",
+    "Py_hash_t",
+    "ptrdiff_t",
+    "intptr_t",
+    "uintptr_t",
+    "int8_t",
+    "int16_t",
+    "int32_t",
+    "int64_t",
+    "uint8_t",
+    "uint16_t",
+    "uint32_t",
+    "uint64_t",
+]
+C_FLOATS = ["float", "double"]
+
+NUMPY_PREFIXES = ["np.", "cnp.", "numpy."]
+NUMPY_INTEGERS = ["int", "uint", "intp", "uintp", "byte", "ubyte", "short", "ushort", "long", "ulong", "longlong"]
+NUMPY_FLOATS = ["float", "double", "longdouble", "half", "single"]
+
+
+def standard_type_map(**kwargs) -> TypeMap:
+    """
+    libc and numpy types to python types, memoryviews to np.ndarray
+    (stubs using it need "import numpy as np")
+    """
+
+    exact = {name: "int" for name in C_INTEGERS}
+    exact.update({name: "float" for name in C_FLOATS})
+    exact.update({"bint": "bool", "Py_UCS4": "str", "Py_UNICODE": "str", "char*": "bytes", "void": "None"})
+    exact.update({"float complex": "complex", "double complex": "complex"})
+
+    prefixes = {}
+    for namespace in NUMPY_PREFIXES:
+        prefixes.update({f"{namespace}{name}": "int" for name in NUMPY_INTEGERS})
+        prefixes.update({f"{namespace}{name}": "float" for name in NUMPY_FLOATS})
+        prefixes.update({f"{namespace}complex": "complex", f"{namespace}bool": "bool"})
+        prefixes[f"{namespace}ndarray"] = "np.ndarray"
+
+    return TypeMap(exact, prefixes, "np.ndarray", **kwargs)
@@ -1,10 +1,18 @@
 from pyparsing import (
+    Forward,
+    ParseException,
     ParserElement,
     Suppress,
     Optional,
+    Token,
+    col,
 )
 from functools import partial
-from typing import List
+from typing import List, Dict, Union
+import re
+
+# cumulative packrat statistics, pyparsing resets its own counters on every scan
+_memoization_stats = {"hits": 0, "misses": 0}
 
 
 def parentheses_suppress(content: ParserElement) -> ParserElement:
@@ -28,3 +36,177 @@ def extend_empty(tokens: List[ParserElement], n: int):
 def EmptyDefault(input: ParserElement, n: int = 1) -> ParserElement:
     """returns empty string ParserResult of size n"""
     return Optional(input).addParseAction(partial(extend_empty, n=n))
+
+
+class SkipIndentedBlock(Token):
+    """
+    matches the same extent as IndentedBlock(expr, recursive=True) by indentation alone
+    the block source text is returned unparsed
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.mayReturnEmpty = True
+        self.mayIndexError = False
+        self.errmsg = "expected indented block"
+
+    def parseImpl(self, instring, loc, do_actions=True):
+        # loc is already advanced to the first statement of the block
+        levels = [col(loc, instring)]
+        end = instring.find("\n", loc)
+        end = len(instring) if end == -1 else end
+
+        while end < len(instring):
+            line_loc = end
+            while line_loc < len(instring) and instring[line_loc] in " \t\r\n":
+                line_loc += 1
+
+            if line_loc == len(instring):
+                break
+
+            line_col = col(line_loc, instring)
+            if line_col > levels[-1]:
+                levels.append(line_col)
+            else:
+                while levels and line_col < levels[-1]:
+                    levels.pop()
+                if not levels or line_col != levels[-1]:
+                    break
+
+            end = instring.find("\n", line_loc)
+            end = len(instring) if end == -1 else end
+
+        text = instring[loc:end]
+
+        # IndentedBlock consumes the trailing whitespace, past the end of the string when it runs out
+        while end < len(instring) and instring[end] in " \t\r\n":
+            end += 1
+        if end == len(instring):
+            end += 1
+
+        return end, text
+
+
+class RawDefault(Token):
+    """
+    source text of a default value up to the next top level comma or closing bracket
+    brackets and strings are balanced instead of parsed, the text is returned as written
+    """
+
+    special = re.compile(r"[()\[\]{},'\"#]")
+
+    def __init__(self):
+        super().__init__()
+        self.mayIndexError = False
+        self.errmsg = "expected default value"
+
+    def _string_end(self, instring: str, loc: int) -> int:
+        quote = instring[loc] * 3 if instring.startswith(instring[loc] * 3, loc) else instring[loc]
+        end = loc + len(quote)
+        while True:
+            end = instring.find(quote, end)
+            if end == -1 or (len(quote) == 1 and "\n" in instring[loc:end]):
+                raise ParseException(instring, loc, "unterminated string", self)
+
+            # an odd number of backslashes escapes the quote
+            backslashes = 0
+            while instring[end - 1 - backslashes] == "\\":
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return end + len(quote)
+            end += 1
+
+    def parseImpl(self, instring, loc, do_actions=True):
+        depth = 0
+        end = loc
+        while True:
+            match = self.special.search(instring, end)
+            if match is None:
+                raise ParseException(instring, loc, self.errmsg, self)
+
+            char, end = match.group(), match.end()
+            if char in "([{":
+                depth += 1
+            elif char in ")]}" or char == ",":
+                if depth == 0:
+                    end = match.start()
+                    break
+                depth -= char != ","
+            elif char == "#":
+                # a comment would end the stub line
+                raise ParseException(instring, match.start(), "comment in default value", self)
+            else:
+                end = self._string_end(instring, match.start())
+
+        text = instring[loc:end].rstrip()
+        if not text:
+            raise ParseException(instring, loc, self.errmsg, self)
+        return loc + len(text), text
+
+
+def _children(element: ParserElement) -> List[ParserElement]:
+    children = list(getattr(element, "exprs", []))
+    expr = getattr(element, "expr", None)
+    if isinstance(expr, ParserElement):
+        children.append(expr)
+    return children
+
+
+def substitute(element: ParserElement, old: ParserElement, new: ParserElement, _copies=None) -> ParserElement:
+    """copy of the grammar below element with every use of old replaced by new, the original is left unchanged"""
+
+    if element is old:
+        return new
+
+    copies = {} if _copies is None else _copies
+    if id(element) in copies:
+        return copies[id(element)]
+
+    # recursive grammars reach a Forward again while its expression is copied
+    copy = Forward() if isinstance(element, Forward) and element.expr is None else element.copy()
+    copies[id(element)] = copy
+
+    if hasattr(element, "exprs"):
+        copy.exprs = [substitute(child, old, new, copies) for child in element.exprs]
+    if isinstance(getattr(element, "expr", None), ParserElement):
+        copy.expr = substitute(element.expr, old, new, copies)
+
+    return copy
+
+
+def enable_memoization(cache_size: Union[int, None] = 128):
+    """enable pyparsing packrat memoization, cache_size=None for an unbounded cache"""
+    ParserElement.enable_packrat(cache_size, force=True)
+    reset_memoization_stats()
+
+
+def disable_memoization():
+    """disable pyparsing packrat memoization"""
+    ParserElement.disable_memoization()
+
+
+def memoization_enabled() -> bool:
+    return ParserElement._packratEnabled
+
+
+def record_memoization_stats():
+    """accumulate the packrat statistics of the last scan"""
+    hits, misses = ParserElement.packrat_cache_stats
+    _memoization_stats["hits"] += hits
+    _memoization_stats["misses"] += misses
+
+
+def memoization_stats() -> Dict[str, int]:
+    """cumulative packrat cache hits and misses since memoization was enabled"""
+    return dict(_memoization_stats)
+
+
+def reset_memoization_stats():
+    _memoization_stats["hits"] = 0
+    _memoization_stats["misses"] = 0
+
+
+def merge_memoization_stats(stats: Dict[str, int]):
+    """add statistics recorded in another process"""
+    _memoization_stats["hits"] += stats["hits"]
+    _memoization_stats["misses"] += stats["misses"]
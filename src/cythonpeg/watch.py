@@ -0,0 +1,251 @@
+from pathlib import Path
+from typing import Callable, Dict, List, Set, Tuple, Union
+import ctypes
+import ctypes.util
+import logging
+import os
+import queue
+import select
+import struct
+import threading
+import time
+from cythonpeg.cache import StubCache
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct("iIII")
+
+
+def _sources(directory: Path) -> Dict[Path, Tuple[int, int]]:
+    """.pyx files below directory -> (mtime_ns, size)"""
+
+    sources = {}
+    for path in directory.rglob("*.pyx"):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        sources[path] = (stat.st_mtime_ns, stat.st_size)
+    return sources
+
+
+class PollingWatcher:
+    """changed .pyx files found by comparing mtime and size of the tree every interval seconds"""
+
+    def __init__(self, directory: Path, interval: float = 0.5):
+        self.directory = Path(directory)
+        self.interval = interval
+        self._sources = _sources(self.directory)
+
+    def wait(self, timeout: float) -> Set[Path]:
+        time.sleep(min(timeout, self.interval))
+
+        sources = _sources(self.directory)
+        changed = {path for path, stat in sources.items() if self._sources.get(path) != stat}
+        self._sources = sources
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """changed .pyx files reported by inotify (linux), new directories are watched as they appear"""
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._directories: Dict[int, Path] = {}
+        self._watch_tree(self.directory)
+
+    def _watch_tree(self, directory: Path) -> Set[Path]:
+        """watch directory and its subdirectories, returns the .pyx files already in them"""
+
+        sources = set()
+        for root, _, files in os.walk(directory):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root), self.MASK)
+            if wd < 0:
+                logger.warning(f"cannot watch {root}: {os.strerror(ctypes.get_errno())}")
+                continue
+
+            self._directories[wd] = Path(root)
+            sources.update(Path(root) / name for name in files if name.endswith(".pyx"))
+
+        return sources
+
+    def wait(self, timeout: float) -> Set[Path]:
+        changed = set()
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return changed
+
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT.unpack_from(buffer, offset)
+            name = os.fsdecode(buffer[offset + EVENT.size : offset + EVENT.size + length].rstrip(b"\0"))
+            offset += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, every source may have changed
+                changed.update(self.directory.rglob("*.pyx"))
+            elif wd in self._directories and name:
+                path = self._directories[wd] / name
+                if mask & IN_ISDIR:
+                    changed.update(self._watch_tree(path))
+                elif name.endswith(".pyx") and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    changed.add(path)
+
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def open_watcher(directory: Path, poll: bool = False, interval: float = 0.5) -> Union[InotifyWatcher, PollingWatcher]:
+    """inotify where available, polling otherwise (or when poll is set)"""
+
+    if not poll:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError):
+            # not linux or no inotify in libc
+            pass
+
+    return PollingWatcher(directory, interval)
+
+
+def _cached_stub_matches(path: Path, cache: StubCache, skip_bodies: bool = False) -> bool:
+    """the .pyi of path is the cached stub of the current source"""
+
+    # imported here, entrypoints imports this module for the cli
+    from cythonpeg.entrypoints import path_config
+
+    try:
+        source = path.read_text()
+        stub = path.with_suffix(".pyi").read_text()
+    except OSError:
+        return False
+
+    entry = cache.get(cache.key(source, path_config(path), skip_bodies=skip_bodies))
+    return entry is not None and entry[0] == stub
+
+
+def outdated_sources(directory: Path, cache: Union[StubCache, None] = None, skip_bodies: bool = False) -> List[Path]:
+    """
+    .pyx files below directory without a .pyi or with an older one that does not match the source
+    unchanged stubs are not rewritten and keep their mtime, a .pyi older than its source is compared
+    with the cached stub of the source (without a cache it is outdated)
+    """
+
+    outdated = []
+    for path, (mtime, _) in sorted(_sources(Path(directory)).items()):
+        stub = path.with_suffix(".pyi")
+        try:
+            if stub.stat().st_mtime_ns >= mtime:
+                continue
+        except OSError:
+            outdated.append(path)
+            continue
+
+        if cache is None or not _cached_stub_matches(path, cache, skip_bodies):
+            outdated.append(path)
+    return outdated
+
+
+def watch(
+    directory: Path,
+    cache: Union[StubCache, None] = None,
+    skip_bodies: bool = False,
+    debounce: float = 0.1,
+    interval: float = 0.5,
+    queue_size: int = 256,
+    poll: bool = False,
+    stop: Union[threading.Event, None] = None,
+    on_result: Union[Callable, None] = None,
+):
+    """
+    regenerate the .pyi of every .pyx below directory that changes, until stop is set
+    the grammar is built once and stays warm, outdated stubs are regenerated on start
+    changes are debounced (a file is queued once no change was seen for debounce seconds)
+    and stubs are generated in a worker thread from a bounded queue, a full queue blocks the watcher
+    on_result is called with the StubResult and the seconds spent on each file
+    """
+
+    # imported here, entrypoints imports this module for the cli
+    from cythonpeg.definitions import build_cython_parser
+    from cythonpeg.entrypoints import _stub_job, log_diagnostics
+    from cythonpeg.tree2string import default_config
+
+    directory = Path(directory)
+    stop = stop or threading.Event()
+    build_cython_parser(skip_bodies, default_config().raw_defaults)
+
+    work: "queue.Queue[Union[Path, None]]" = queue.Queue(queue_size)
+    queued: Set[Path] = set()
+
+    def worker():
+        while True:
+            path = work.get()
+            if path is None:
+                return
+
+            # changes from here on queue the file again
+            queued.discard(path)
+            start = time.perf_counter()
+            result = _stub_job(path, cache, skip_bodies)
+            seconds = time.perf_counter() - start
+
+            if on_result is not None:
+                on_result(result, seconds)
+            elif result.error:
+                logger.error(f"{result.path}: {result.error}")
+            else:
+                log_diagnostics(result.path, result.diagnostics)
+                status = "written" if result.written else "unchanged"
+                logger.info(f"{result.path}: {status}, {1000 * seconds:.1f} ms, {result.unparsed} unparsed characters")
+
+    def enqueue(path: Path):
+        if path not in queued:
+            queued.add(path)
+            work.put(path)
+
+    thread = threading.Thread(target=worker, name="cythonpeg-watch", daemon=True)
+    thread.start()
+
+    watcher = open_watcher(directory, poll, interval)
+    try:
+        for path in outdated_sources(directory, cache, skip_bodies):
+            enqueue(path)
+
+        pending: Dict[Path, float] = {}
+        while not stop.is_set():
+            for path in watcher.wait(debounce if pending else interval):
+                pending[path] = time.monotonic()
+
+            now = time.monotonic()
+            for path, changed in list(pending.items()):
+                if now - changed >= debounce:
+                    del pending[path]
+                    enqueue(path)
+    finally:
+        work.put(None)
+        thread.join()
+        watcher.close()
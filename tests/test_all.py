@@ -3,6 +3,7 @@ from pathlib import Path
 import cythonpeg
 import pytest
 import ast
+import itertools
 
 
 def partial_type(type_str: str) -> str:
@@ -69,6 +70,710 @@ def test_python_valid(file: Path):
         pytest.fail(f"Exception in {file}: {e}")
 
 
+def test_memoization_matches_default():
+    input_string = "\n".join(file.read_text() for file in sorted(_glob("*.pyx")))
+    expected = cythonpeg.cython_string_2_stub(input_string)
+
+    cythonpeg.enable_memoization(256)
+    try:
+        assert cythonpeg.cython_string_2_stub(input_string) == expected
+        stats = cythonpeg.memoization_stats()
+        assert stats["hits"] > 0 and stats["misses"] > 0
+    finally:
+        cythonpeg.disable_memoization()
+
+
+@pytest.mark.parametrize("file", _glob("*.pyx"))
+def test_skip_bodies_matches_default(file: Path):
+    input_string = file.read_text()
+    expected = cythonpeg.cython_string_2_stub(input_string)
+    assert cythonpeg.cython_string_2_stub(input_string, skip_bodies=True) == expected
+
+
+def test_skip_bodies_nested():
+    input_string = "\n".join(
+        [
+            "cdef class Outer:",
+            "    cdef int a",
+            "    def method(self, int b):",
+            "        if b:",
+            "            def inner(c):",
+            "                return c",
+            "",
+            "        return b",
+            "    cpdef double other(self):",
+            "        return 1.0",
+            "",
+            "def kernel(x):",
+            "    for i in range(10):",
+            "        x += i",
+            "    return x",
+            "",
+        ]
+    )
+    expected = cythonpeg.cython_string_2_stub(input_string)
+    assert cythonpeg.cython_string_2_stub(input_string, skip_bodies=True) == expected
+
+
+@pytest.mark.parametrize("file", _glob("*.pyx"))
+def test_dispatch_scan_matches_scan_string(file: Path):
+    from cythonpeg.definitions import build_cython_parser, dispatch_scan
+
+    input_string = file.read_text() + "\nx = 1  # unparsed\n@decorator\ndef after(a):\n    return a\n"
+    input_string += "async def coroutine(a, b):\n    await a\nasync with a:\n    pass\n"
+
+    expected = [(t.dump(), s, e) for t, s, e in build_cython_parser().scan_string(input_string)]
+    assert [(t.dump(), s, e) for t, s, e in dispatch_scan(input_string)] == expected
+
+
+def test_unparsed_spans():
+    input_string = "def a(x):\n    return x\n\nx = 1\n\ncdef class B:\n    pass\n\n  y = 2   \n"
+    report = cythonpeg.cython_string_2_report(input_string)
+
+    assert report.unparsed_text == cythonpeg.cython_string_2_stub(input_string)[1]
+    assert [(span.text, span.line, span.column) for span in report.unparsed] == [("x = 1", 4, 1), ("y = 2", 9, 3)]
+    assert 0 < report.coverage < 100
+
+
+@pytest.mark.parametrize("file", _glob("*.pyx"))
+def test_stub_fragments(file: Path):
+    input_string = file.read_text()
+    stub_file, _ = cythonpeg.cython_string_2_stub(input_string)
+
+    fragments = list(cythonpeg.iter_stub_fragments(input_string))
+    assert "\n".join(fragment.text for fragment in fragments if fragment.text) == stub_file
+    assert all(a.end <= b.start for a, b in zip(fragments, fragments[1:]))
+
+
+def test_parallel_generation_matches_serial(tmp_path: Path):
+    from cythonpeg.entrypoints import generate_stubs
+
+    paths = []
+    for file in sorted(_glob("*.pyx")):
+        path = tmp_path / file.name
+        path.write_text(file.read_text())
+        paths.append(path)
+
+    serial = list(generate_stubs(paths))
+    serial_stubs = [path.with_suffix(".pyi").read_text() for path in paths]
+
+    parallel = list(generate_stubs(paths, jobs=2))
+    parallel_stubs = [path.with_suffix(".pyi").read_text() for path in paths]
+
+    assert [r.path for r in parallel] == paths
+    assert [(r.unparsed, r.error) for r in parallel] == [(r.unparsed, r.error) for r in serial]
+    assert parallel_stubs == serial_stubs
+
+
+def test_split_blocks_memoization_stats(tmp_path: Path):
+    from cythonpeg.entrypoints import generate_stubs
+    from cythonpeg.utilities import memoization_stats, reset_memoization_stats
+
+    path = tmp_path / "a.pyx"
+    path.write_text("\n".join(file.read_text() for file in sorted(_glob("*.pyx"))))
+
+    # the statistics recorded in the block workers reach this process
+    reset_memoization_stats()
+    results = list(generate_stubs([path], jobs=2, memoize_size=128, split_blocks=True))
+    assert results[0].memoization["misses"] > 0 and memoization_stats() == results[0].memoization
+    reset_memoization_stats()
+
+
+@pytest.mark.parametrize("split_blocks", [False, True])
+def test_parallel_generation_spawn(tmp_path: Path, split_blocks: bool):
+    import subprocess
+    import sys
+
+    # spawned workers do not inherit the set_* globals, the config has to be passed to them
+    path = tmp_path / "a.pyx"
+    path.write_text("def f(double[:] arr):\n    pass\n\ndef g(int a):\n    pass\n")
+    code = (
+        "import multiprocessing, cythonpeg\n"
+        "from cythonpeg.entrypoints import generate_stubs\n"
+        "multiprocessing.set_start_method('spawn')\n"
+        "type_map = cythonpeg.standard_type_map()\n"
+        "cythonpeg.set_type_converter_partial(type_map.partial)\n"
+        "cythonpeg.set_type_converter_complete(type_map.complete)\n"
+        f"paths = [cythonpeg.entrypoints.Path({str(path)!r})] * 2\n"
+        f"assert not any(result.error for result in generate_stubs(paths, jobs=2, split_blocks={split_blocks}))\n"
+    )
+    src = str(Path(cythonpeg.__file__).parent.parent)
+    subprocess.run([sys.executable, "-c", code], check=True, env={"PYTHONPATH": src})
+    assert "def f(arr: np.ndarray):" in path.with_suffix(".pyi").read_text()
+
+
+def test_stub_cache(tmp_path: Path, monkeypatch):
+    from cythonpeg import entrypoints
+    from cythonpeg.cache import StubCache
+
+    cache = StubCache(tmp_path / "cache")
+    path = tmp_path / "function_a.pyx"
+    path.write_text((Path(__file__).parent / "cython" / "function_a.pyx").read_text())
+
+    assert entrypoints.stub_from_path(path, cache) == (0, False, True)
+    stub_file = path.with_suffix(".pyi").read_text()
+    path.with_suffix(".pyi").unlink()
+
+    def fail(input_code):
+        raise AssertionError("cache hit should not parse")
+
+    monkeypatch.setattr(entrypoints, "cython_string_2_report", fail)
+    assert entrypoints.stub_from_path(path, cache) == (0, True, True)
+    assert path.with_suffix(".pyi").read_text() == stub_file
+
+    cache.max_size = 0
+    assert cache.evict() == 1
+    assert cache.get(cache.key(path.read_text())) is None
+
+
+def test_segmented_report_matches_serial():
+    input_string = "\n".join(
+        [
+            "import os",
+            "from a import (",
+            "    b,",
+            ")",
+            "cimport c",
+            "s = '''",
+            "def in_string():",
+            "    pass",
+            "'''",
+            "def f(a,",
+            "b):",
+            "    return a",
+            "# comment",
+            "x = 1",
+            "@decorator",
+            "def g(a):",
+            "    return a",
+            "",
+            "",
+            "#directive",
+            "",
+        ]
+    )
+    blocks = cythonpeg.segment_blocks(input_string)
+    assert len(blocks) > 1 and blocks[0][0] == 0 and blocks[-1][1] == len(input_string)
+
+    expected = cythonpeg.cython_string_2_report(input_string)
+    assert cythonpeg.cython_string_2_report_blocks(input_string, jobs=1) == expected
+
+
+def test_segmented_report_process_pool():
+    input_string = "\n".join(file.read_text() for file in sorted(_glob("*.pyx")))
+    expected = cythonpeg.cython_string_2_report(input_string)
+    assert cythonpeg.cython_string_2_report_blocks(input_string, jobs=2) == expected
+
+
+def test_grammar_profiler():
+    input_string = (Path(__file__).parent / "cython" / "class_a.pyx").read_text()
+    expected = cythonpeg.cython_string_2_stub(input_string)
+
+    with cythonpeg.GrammarProfiler() as profiler:
+        assert cythonpeg.cython_string_2_stub(input_string) == expected
+
+    profile = profiler.as_dict()
+    assert profile["elements"]["type_definition"]["successes"] > 0
+    assert profile["elements"]["alternative cclass"]["attempts"] > 0
+    assert profile["emitters"]["class2str"]["successes"] == 1
+    assert "alternative cclass" in profiler.table()
+
+    # instrumentation is removed on exit
+    with cythonpeg.GrammarProfiler() as unused:
+        pass
+    cythonpeg.cython_string_2_stub(input_string)
+    assert not unused.as_dict()["elements"] and not unused.as_dict()["emitters"]
+
+
+def test_import_is_lazy():
+    import subprocess
+    import sys
+
+    # the grammar and pyparsing are only imported on first parse, logging is left to the application
+    code = (
+        "import sys, logging, cythonpeg\n"
+        "cythonpeg.set_type_converter_partial(str)\n"
+        "assert 'pyparsing' not in sys.modules and 'cythonpeg.definitions' not in sys.modules\n"
+        "assert not logging.getLogger().handlers\n"
+        "cythonpeg.cython_string_2_stub('def f(a):\\n    pass\\n')\n"
+        "assert 'cythonpeg.definitions' in sys.modules\n"
+    )
+    src = str(Path(cythonpeg.__file__).parent.parent)
+    subprocess.run([sys.executable, "-c", code], check=True, env={"PYTHONPATH": src})
+
+
+def test_stub_config_threads():
+    from concurrent.futures import ThreadPoolExecutor
+
+    input_string = "\n".join(file.read_text() for file in sorted(_glob("*.pyx")))
+    configs = [
+        cythonpeg.StubConfig(),
+        cythonpeg.StubConfig(lambda t: "float" if "double" in t else t, str.upper, "\t"),
+    ]
+    expected = [cythonpeg.cython_string_2_stub(input_string, config=config) for config in configs]
+    assert expected[0] != expected[1] and "\tdef" in expected[1][0]
+
+    # the module defaults (test converters) are not used when a config is given
+    assert cythonpeg.cython_string_2_stub(input_string) != expected[0]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(
+            executor.map(lambda i: cythonpeg.cython_string_2_stub(input_string, config=configs[i % 2]), range(8))
+        )
+
+    assert results == [expected[i % 2] for i in range(8)]
+
+
+def test_type_map():
+    type_map = cythonpeg.TypeMap(
+        {"double": "float"}, {"np.int": "int", "np.int8": "bytes"}, "np.ndarray", fallback_partial=str.upper
+    )
+    assert type_map.partial("double") == "float"
+    assert type_map.partial("np.int8_t") == "bytes" and type_map.partial("np.int32_t") == "int"
+    assert type_map.partial("object") == "OBJECT"
+    assert type_map.complete("float[:, ::1]") == "np.ndarray" and type_map.complete("List[int]") == "List[int]"
+
+    type_map.partial("double")
+    assert type_map.stats()["partial"]["hits"] == 1 and type_map.stats()["partial"]["misses"] == 4
+
+    code = "cdef np.float64_t f(double[:] a, cnp.int32_t b, unsigned long c, bint d):\n    return a[0]\n"
+    stub, unparsed = cythonpeg.cython_string_2_stub(code, config=cythonpeg.standard_type_map().config())
+    assert "def f(a: np.ndarray, b: int, c: int, d: bool) -> float:" in stub and not unparsed
+
+    # pickles for worker processes, different tables get different cache keys
+    import pickle
+    from cythonpeg.cache import config_fingerprint
+
+    assert pickle.loads(pickle.dumps(type_map)).partial("np.int8_t") == "bytes"
+    config = pickle.loads(pickle.dumps(cythonpeg.standard_type_map().config()))
+    assert config.type_converter_partial("cnp.int32_t") == "int"
+
+    # the config reaches worker processes
+    results = list(cythonpeg.cython_sources_2_stubs([("f.pyx", code)] * 2, config=config, jobs=2))
+    assert [result.stub for result in results] == [stub] * 2
+    assert config_fingerprint(type_map.config()) != config_fingerprint(cythonpeg.TypeMap().config())
+
+
+def test_ir_module():
+    import pickle
+    from cythonpeg import ir
+
+    input_string = "\n".join(file.read_text() for file in sorted(_glob("*.pyx")))
+    config = cythonpeg.StubConfig()
+    module = cythonpeg.cython_string_2_module(input_string, config=config)
+
+    # the IR pickles and emits the same stub as a direct parse
+    assert pickle.loads(pickle.dumps(module)) == module
+    assert cythonpeg.module2str(module, config) == cythonpeg.cython_string_2_stub(input_string, config=config)[0]
+
+    module = cythonpeg.cython_string_2_module(
+        "cdef class A(B):\n    cpdef int f(self, double[:] x=None) nogil:\n        pass\n"
+    )
+    assert module.body == [
+        ir.ClassDef(
+            "A",
+            "B",
+            body=[
+                ir.FunctionDef(
+                    "f",
+                    [ir.Arg("self"), ir.Arg("x", ir.Type("double", [ir.Type(":")]), "None", True)],
+                    ir.Type("int"),
+                    cython=True,
+                    qualifier="nogil",
+                )
+            ],
+            cython=True,
+        )
+    ]
+
+
+def test_nested_emission():
+    from cythonpeg import ir
+
+    method = ir.FunctionDef("f", [ir.Arg("self")], ir.Type("int"), "first\n\nlast", True)
+    inner = ir.ClassDef("B", body=[method], cython=True)
+    outer = ir.ClassDef("A", body=[inner, ir.ClassDef("C")], cython=True)
+
+    # non blank lines are indented once per level, blank docstring lines stay blank
+    assert cythonpeg.module2str(ir.Module([outer]), cythonpeg.StubConfig()) == (
+        "class A:\n\n"
+        "    class B:\n\n"
+        '        def f(self) -> int:\n            """first\n\n        last"""\n            ...\n\n'
+        "    class C:\n\n        ...\n"
+    )
+
+
+@pytest.mark.parametrize("poll", [False, True])
+def test_watch(tmp_path: Path, poll: bool):
+    import queue
+    import threading
+    from cythonpeg.watch import watch
+
+    (tmp_path / "a.pyx").write_text("def a(int x):\n    pass\n")
+
+    results, stop = queue.Queue(), threading.Event()
+    thread = threading.Thread(
+        target=watch,
+        args=(tmp_path,),
+        kwargs=dict(debounce=0.05, interval=0.05, poll=poll, stop=stop, on_result=lambda r, s: results.put(r)),
+    )
+    thread.start()
+
+    try:
+        # outdated stubs are generated on start, then only changed files
+        assert results.get(timeout=30).path == tmp_path / "a.pyx"
+        (tmp_path / "sub").mkdir()
+        (tmp_path / "sub" / "b.pyx").write_text("def b(y):\n    pass\n")
+        assert results.get(timeout=30).path == tmp_path / "sub" / "b.pyx"
+        assert (tmp_path / "sub" / "b.pyi").read_text() == "def b(y):\n    ...\n"
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_outdated_sources(tmp_path: Path):
+    import os
+    from cythonpeg.cache import StubCache
+    from cythonpeg.entrypoints import stub_from_path
+    from cythonpeg.watch import outdated_sources
+
+    path = tmp_path / "a.pyx"
+    path.write_text("def a(int x):\n    pass\n")
+    cache = StubCache(tmp_path / "cache")
+    assert outdated_sources(tmp_path, cache) == [path]
+
+    stub_from_path(path, cache)
+    assert outdated_sources(tmp_path, cache) == []
+
+    # a touched source keeps its unchanged stub, which then is older than the source
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert stub_from_path(path, cache) == (0, True, False)
+    assert outdated_sources(tmp_path, cache) == [] and outdated_sources(tmp_path) == [path]
+
+    path.write_text("def a(int x, y):\n    pass\n")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+    assert outdated_sources(tmp_path, cache) == [path]
+
+
+def test_write_if_changed(tmp_path: Path, monkeypatch):
+    import os
+    from cythonpeg import entrypoints
+    from cythonpeg.entrypoints import stub_from_path
+
+    path = tmp_path / "function_a.pyx"
+    path.write_text((Path(__file__).parent / "cython" / "function_a.pyx").read_text())
+
+    # without a cache the fragments are streamed into the stub, the whole stub is never built
+    monkeypatch.setattr(entrypoints, "cython_string_2_report", None)
+    assert stub_from_path(path)[2]
+    stub = path.with_suffix(".pyi")
+    assert stub.read_text() == cythonpeg.cython_string_2_stub(path.read_text())[0]
+    os.utime(stub, ns=(0, 0))
+
+    # identical output leaves the stub and its mtime alone
+    assert not stub_from_path(path)[2]
+    assert stub.stat().st_mtime_ns == 0
+
+    stub.write_text("stale")
+    stub.chmod(0o640)
+    assert stub_from_path(path)[2]
+    assert stub.read_text() != "stale" and stub.stat().st_mode & 0o777 == 0o640
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith(".tmp")] == []
+
+
+def test_symbol_index(tmp_path: Path):
+    from cythonpeg.cache import StubCache
+
+    (tmp_path / "types.pxd").write_text(
+        "ctypedef double real\nctypedef real scalar\ncdef struct Point:\n    double x\ncdef enum Color:\n    RED\n"
+    )
+    module = tmp_path / "module.pyx"
+    module.write_text(
+        "cdef struct Local:\n    int a\n\ncpdef scalar f(Point p, Color c, Local l, scalar[:] v):\n    pass\n"
+    )
+
+    cache = StubCache(tmp_path / "cache")
+    for _ in range(2):  # second build reads the cache
+        index = cythonpeg.build_symbol_index([tmp_path / "types.pxd", module], cache=cache)
+        assert index.resolve("scalar") == "double" and index.resolve("Point") == "dict"
+
+    # names defined in the stubbed file stay as they are
+    config = cythonpeg.StubConfig(symbols=index.for_file(module))
+    stub, _ = cythonpeg.cython_string_2_stub(module.read_text(), config=config)
+    assert "def f(p: dict, c: int, l: Local, v: double[:]) -> double:" in stub
+
+
+@pytest.mark.parametrize("file", sorted((Path(__file__).parent / "cython").glob("*.pyx")), ids=lambda path: path.name)
+def test_cython_engine(file: Path):
+    source = file.read_text()
+
+    # same stubs from Cython's parse tree as from the grammar
+    expected = cythonpeg.cython_string_2_stub(source, config=cythonpeg.StubConfig())
+    assert cythonpeg.cython_string_2_stub(source, config=cythonpeg.StubConfig(engine="cython")) == expected
+
+
+def test_cython_engine_defaults():
+    import ast
+
+    # defaults both engines parse are written alike, string quotes as in the source
+    source = "def f(a=\"x\", b='y', c=(1, 2), d=-1, e=[1, 2.5], g=h.k):\n    pass\n"
+    expected = cythonpeg.cython_string_2_stub(source, config=cythonpeg.StubConfig())
+    assert cythonpeg.cython_string_2_stub(source, config=cythonpeg.StubConfig(engine="cython")) == expected
+
+    source = 'def f(i=not True, t=(1,), b=b"z", s=r\'\\d\' "x", n=-(2)):\n    pass\n'
+    stub, unparsed = cythonpeg.cython_string_2_stub(source, config=cythonpeg.StubConfig(engine="cython"))
+    assert stub == 'def f(i=not True, t=(1,), b=b"z", s=r\'\\d\' "x", n=-2):\n    ...\n' and not unparsed
+    ast.parse(stub)
+
+
+def test_cython_engine_fallback():
+    config = cythonpeg.StubConfig(engine="cython")
+
+    # syntax Cython rejects is left to the grammar and reported as unparsed
+    stub, unparsed = cythonpeg.cython_string_2_stub("def f(a):\n    pass\n\ndef broken(:\n    pass\n", config=config)
+    assert stub == "def f(a):\n    ...\n" and "broken" in unparsed
+
+    # constructs the grammar does not cover
+    stub, unparsed = cythonpeg.cython_string_2_stub("cdef unsigned long g(int* a):\n    pass\n", config=config)
+    assert stub == "def g(a: int*) -> unsigned long:\n    ...\n" and not unparsed
+
+    with pytest.raises(ValueError):
+        cythonpeg.set_engine("lark")
+
+
+def test_error_recovery():
+    input_string = (
+        "@property\ndef x(self):\n    return 1\n\n"
+        "class A(metaclass=M):\n    def m(self):\n        pass\n\n"
+        "def g(a: int) -> int:\n    return a\n"
+    )
+
+    # without recovery the methods of the failed class are picked up as top level functions
+    assert "def m(self)" in cythonpeg.cython_string_2_stub(input_string)[0]
+
+    config = cythonpeg.StubConfig(recover=True)
+    report = cythonpeg.cython_string_2_report(input_string, config=config)
+    assert report.stub == "def x(self):\n    ...\n\ndef g(a: int) -> int:\n    ...\n"
+    assert [(d.line, d.end_line) for d in report.diagnostics] == [(5, 7)]
+    assert report.diagnostics[0].reason == "class: Expected ':', found '(' at line 5, column 8"
+    assert "class A(metaclass=M)" in report.unparsed_text
+
+    blocks = cythonpeg.cython_string_2_report_blocks(input_string, jobs=1, config=config)
+    assert blocks == report
+
+    # decorators are not failed definitions
+    input_string = (
+        "@cython.boundscheck(False)\n@cython.wraparound(False)\ncpdef int f(int a):\n    return a\n\n"
+        "cdef class B:\n    @staticmethod\n    def s(a):\n        pass\n\n"
+        "    @property\n    def p(self):\n        return 1\n"
+    )
+    report = cythonpeg.cython_string_2_report(input_string, config=config)
+    assert report.diagnostics == [] and "def s(a):" in report.stub and "def p(self):" in report.stub
+
+
+def test_error_recovery_blocks_match_serial():
+    # a skipped definition ends at its top level block, the block and incremental reports match the serial one
+    pieces = [
+        "cdef inline int f(int a) nogil:\n    return a\n",
+        "if True:\n    def f(a):\n        pass\n",
+        "x = 1\n",
+        "def g(a, b):\n    pass\n",
+        "cdef class B:\n    cdef inline int f(self) nogil:\n        pass\n    def ok(self):\n        pass\n",
+        "@cython.boundscheck(False)\ndef k(a):\n    pass\n",
+        "# comment\n",
+    ]
+    config = cythonpeg.StubConfig(recover=True)
+    for first, second in itertools.permutations(pieces, 2):
+        for input_string in (first + second, first + "\n" + second):
+            expected = cythonpeg.cython_string_2_report(input_string, config=config)
+            assert cythonpeg.cython_string_2_report_blocks(input_string, jobs=1, config=config) == expected
+            assert cythonpeg.IncrementalStub(config=config).update(input_string) == expected
+
+    input_string = "cdef inline int f(int a) nogil:\n    return a\n\nif True:\n    def f(a):\n        pass\n"
+    report = cythonpeg.cython_string_2_report(input_string, config=config)
+    assert report.stub == "def f(a):\n    ...\n" and [(d.line, d.end_line) for d in report.diagnostics] == [(1, 2)]
+
+
+def test_error_recovery_summary(tmp_path: Path, monkeypatch, caplog):
+    import logging
+    from cythonpeg import tree2string
+    from cythonpeg.entrypoints import generate_stubs, log_summary
+
+    # diagnostics are returned from the workers and logged with the summary
+    monkeypatch.setattr(tree2string, "RECOVER", True)
+    paths = [tmp_path / "a.pyx", tmp_path / "b.pyx"]
+    for path in paths:
+        path.write_text("class A(metaclass=M):\n    pass\n\ndef g(a):\n    pass\n")
+
+    results = list(generate_stubs(paths, jobs=2))
+    assert [[(d.line, d.end_line) for d in result.diagnostics] for result in results] == [[(1, 2)]] * 2
+
+    with caplog.at_level(logging.WARNING, logger="cythonpeg.entrypoints"):
+        log_summary(results)
+    assert all(f"{path}:1: skipped to line 2" in caplog.text for path in paths)
+
+
+def test_raw_defaults():
+    config = cythonpeg.StubConfig(raw_defaults=True)
+
+    # balanced brackets and strings up to the next top level comma, emitted as written
+    input_string = "def f(a={1: [1, 2]}, b='x,)', c=lambda x: x, d=g(1, k=(2,))):\n    pass\n"
+    stub, unparsed = cythonpeg.cython_string_2_stub(input_string, config=config)
+    assert stub == "def f(a={1: [1, 2]}, b='x,)', c=lambda x: x, d=g(1, k=(2,))):\n    ...\n" and not unparsed
+
+    input_string = "cdef int g(int a=1 + 2, np.ndarray[double, ndim=2] b=None):\n    pass\n"
+    stub, _ = cythonpeg.cython_string_2_stub(input_string, config=config)
+    assert stub == "def g(a: int = 1 + 2, b: np.ndarray[double, ndim=2] = None) -> int:\n    ...\n"
+
+    # defaults without formatting differences match the parsed ones
+    for file in (Path(__file__).parent / "cython").glob("class_*.pyx"):
+        input_string = file.read_text()
+        expected = cythonpeg.cython_string_2_stub(input_string, config=cythonpeg.StubConfig())
+        assert cythonpeg.cython_string_2_stub(input_string, config=config) == expected
+
+
+@pytest.mark.parametrize("engine", ["pyparsing", "cython"])
+def test_extern_declarations(engine: str):
+    input_string = (
+        'cdef extern from "geo.h" nogil:\n'
+        "    ctypedef struct Point:\n        double x\n        const double* y  # comment\n"
+        "        void (*callback)(int)\n\n"
+        "    cdef enum Color:\n        RED = 1,\n        GREEN = 1 << 2\n\n"
+        "    cdef struct Forward\n"
+        "    double distance(Point a, Point b)\n\n"
+        "def f(Point p):\n    pass\n"
+    )
+
+    # extern blocks are skipped whole and still count as parsed
+    report = cythonpeg.cython_string_2_report(input_string, config=cythonpeg.StubConfig(engine=engine))
+    assert report.stub == "def f(p: Point):\n    ...\n" and report.coverage == 100.0
+
+    config = cythonpeg.StubConfig(engine=engine, extern_declarations=True)
+    report = cythonpeg.cython_string_2_report(input_string, config=config)
+    assert report.stub == (
+        "class Point:\n    x: double\n    y: double*\n\n"
+        "class Color(Enum):\n    RED: int\n    GREEN: int\n\n"
+        "def f(p: Point):\n    ...\n"
+    )
+    assert report.coverage == 100.0
+
+
+def test_incremental_stub():
+    input_string = "\n\n".join(file.read_text() for file in sorted(_glob("*.pyx")))
+    config = cythonpeg.default_config()
+    incremental = cythonpeg.IncrementalStub(config=config)
+
+    assert incremental.update(input_string) == cythonpeg.cython_string_2_report(input_string, config=config)
+    total = incremental.parsed + incremental.reused
+
+    # only the changed and added blocks are parsed again, unchanged blocks move with the edits above them
+    edited = "def added(int a):\n    pass\n\n" + input_string.replace("cdef int", "cdef long", 1)
+    assert incremental.update(edited) == cythonpeg.cython_string_2_report(edited, config=config)
+    assert incremental.parsed == 2 and incremental.reused == total - 1
+
+    assert incremental.update(input_string) == cythonpeg.cython_string_2_report(input_string, config=config)
+    assert incremental.parsed == 1
+
+
+def test_async_api(tmp_path: Path):
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor
+    from cythonpeg.entrypoints import stub_from_path
+
+    file = Path(__file__).parent / "cython" / "class_a.pyx"
+    input_string = file.read_text()
+    expected = cythonpeg.cython_string_2_stub(input_string)
+
+    async def main():
+        assert await cythonpeg.cython_string_2_stub_async(input_string) == expected
+        assert await cythonpeg.cython_file_2_stub_async(file) == expected
+
+        async with cythonpeg.AsyncStubGenerator(limit=2) as generator:
+            # an edit burst only parses the latest version, the stale requests are cancelled
+            versions = [input_string + f"\ndef f{i}():\n    pass\n" for i in range(5)]
+            results = await asyncio.gather(*(generator.stub(v, "a.pyx") for v in versions), return_exceptions=True)
+            assert all(isinstance(result, asyncio.CancelledError) for result in results[:-1])
+            assert results[-1] == cythonpeg.cython_string_2_stub(versions[-1])
+
+            # requests without a name or with different names run side by side
+            assert await asyncio.gather(generator.stub(input_string), generator.stub_file(file)) == [expected] * 2
+
+            path = tmp_path / "a.pyx"
+            path.write_text(input_string)
+            assert await generator.stub_path(path) == (len(expected[1]), False, True)
+            assert await generator.stub_path(path) == (len(expected[1]), False, False)
+
+        # an explicit config is used as given
+        other = tmp_path / "b.pyx"
+        other.write_text("class A:\n  def m(self):\n    pass\n")
+        config = cythonpeg.StubConfig(indent="  ")
+        assert await cythonpeg.stub_from_path_async(other, config=config) == (0, False, True)
+        assert other.with_suffix(".pyi").read_text() == cythonpeg.cython_file_2_stub(other, config=config)[0]
+
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            async with cythonpeg.AsyncStubGenerator(executor, limit=1) as generator:
+                assert await generator.stub(input_string, "a.pyx") == expected
+
+    asyncio.run(main())
+    assert stub_from_path(tmp_path / "a.pyx") == (len(expected[1]), False, False)
+
+
+def test_async_api_spawn(tmp_path: Path):
+    import subprocess
+    import sys
+
+    # spawned workers do not inherit the set_* globals, the config is resolved before the parse is submitted
+    path = tmp_path / "a.pyx"
+    path.write_text("def f(double[:] arr):\n    pass\n")
+    code = (
+        "import asyncio, multiprocessing, cythonpeg\n"
+        "from concurrent.futures import ProcessPoolExecutor\n"
+        "multiprocessing.set_start_method('spawn')\n"
+        "type_map = cythonpeg.standard_type_map()\n"
+        "cythonpeg.set_type_converter_partial(type_map.partial)\n"
+        "cythonpeg.set_type_converter_complete(type_map.complete)\n"
+        "async def main():\n"
+        "    with ProcessPoolExecutor(max_workers=1) as executor:\n"
+        "        source = 'def f(double[:] arr):\\n    pass\\n'\n"
+        "        assert 'np.ndarray' in (await cythonpeg.cython_string_2_stub_async(source, executor=executor))[0]\n"
+        "        async with cythonpeg.AsyncStubGenerator(executor) as generator:\n"
+        "            assert 'np.ndarray' in (await generator.stub('def g(double[:] arr):\\n    pass\\n'))[0]\n"
+        f"        await cythonpeg.stub_from_path_async({str(path)!r}, executor=executor)\n"
+        "asyncio.run(main())\n"
+    )
+    src = str(Path(cythonpeg.__file__).parent.parent)
+    subprocess.run([sys.executable, "-c", code], check=True, env={"PYTHONPATH": src})
+    assert "def f(arr: np.ndarray):" in path.with_suffix(".pyi").read_text()
+
+
+def test_batch(tmp_path: Path):
+    files = sorted(_glob("*.pyx"))
+    config = cythonpeg.default_config()
+    items = [files[0], ("inline.pyx", "def f(int a):\n    pass\n"), tmp_path / "missing.pyx", *files[1:]]
+
+    results = cythonpeg.cython_sources_2_stubs(iter(items), config=config)
+    assert not isinstance(results, list)
+    results = list(results)
+
+    assert [result.name for result in results] == [item[0] if isinstance(item, tuple) else str(item) for item in items]
+    assert results[1].stub == "def f(a: int):\n    ...\n" and results[1].coverage == 100.0
+    assert results[2].error.startswith("FileNotFoundError") and not results[2].stub
+    for file, result in zip([files[0], *files[1:]], [results[0], *results[3:]]):
+        report = cythonpeg.cython_string_2_report(file.read_text(), config=config)
+        assert result.stub == report.stub and result.unparsed == report.unparsed
+        assert result.seconds > 0 and not result.error
+
+    pooled = list(cythonpeg.cython_sources_2_stubs(items, config=config, jobs=2))
+    assert [result._replace(seconds=0) for result in pooled] == [result._replace(seconds=0) for result in results]
+
+    # a config the workers cannot receive fails each item instead of the batch
+    config = config._replace(type_converter_partial=lambda type_str: type_str)
+    failed = list(cythonpeg.cython_sources_2_stubs(items[:2], config=config, jobs=2))
+    assert [result.name for result in failed] == [str(items[0]), "inline.pyx"]
+    assert all(result.error and not result.stub for result in failed)
+
+
 if __name__ == "__main__":
     # runs until first failed assert
     for file in (Path(__file__).parent / "cython").glob("*.pyi"):